@@ -2,9 +2,20 @@ import streamlit as st
 import pymongo
 import pandas as pd
 from datetime import datetime
-import re
+import heapq
 import requests
-from io import BytesIO
+
+from barcodes import BarcodeAllocator
+from browse import get_canonical_product, invalidate_listings, list_canonical_products
+from catalog import normalize_item_name, sub_chain_key_for
+from db import LazyCollection, get_query_executor, reference_cache, search_results_cache
+from ranking import rank_products
+from mappings import chain_items, find_conflicts, get_item_mappings
+from query_plan import candidate_rank, compile_query, get_exclude_matcher, match_relevance
+from search_index import get_search_index
+from sheets import google_sheet_export_link, is_url, load_sheet
+from snapshot import get_snapshot
+import tracing
 
 # Try importing openpyxl, if not installed, show error message
 try:
@@ -12,38 +23,40 @@ try:
 except ImportError:
     st.error("Missing optional dependency 'openpyxl'. Please install openpyxl via 'pip install openpyxl'.")
 
-# MongoDB connection
-def get_mongo_client():
-    MONGO_USERNAME = st.secrets["mongo"]["MONGO_USERNAME"]
-    MONGO_PASSWORD = st.secrets["mongo"]["MONGO_PASSWORD"]
-    MONGO_CLUSTER = st.secrets["mongo"]["MONGO_CLUSTER"]
-
-    MONGO_URI = f"mongodb+srv://{MONGO_USERNAME}:{MONGO_PASSWORD}@{MONGO_CLUSTER}/?retryWrites=true&w=majority"
+# MongoDB collections; the pooled client is created on first use (see db.py)
+# and calls are timed when tracing is enabled (see tracing.py)
+products_collection = tracing.traced(LazyCollection("products"))
+canonical_products_collection = tracing.traced(LazyCollection("canonical_products"))
+chains_collection = tracing.traced(LazyCollection("chains"))
+sub_chains_collection = tracing.traced(LazyCollection("sub_chains"))
+counters_collection = tracing.traced(LazyCollection("counters"))
 
-    client = pymongo.MongoClient(MONGO_URI)
-    return client
+# Search results shown per sub-chain after fuzzy ranking
+RESULTS_PER_SUB_CHAIN = 20
 
-client = get_mongo_client()
-db = client["supermarkets"]
+# Matches read per sub-chain from Mongo and narrowed to the closest ones
+SUB_CHAIN_CANDIDATES = 200
 
-products_collection = db["products"]
-canonical_products_collection = db["canonical_products"]
-chains_collection = db["chains"]
-sub_chains_collection = db["sub_chains"]
+# Canonical products per page in the "View Canonical Products" tab
+BROWSE_PAGE_SIZE = 50
 
 # Global chain and sub-chain mappings
 chain_dict = {}
 sub_chain_dict = {}
 
+def load_chain_names():
+    chains = list(chains_collection.find({}, {"_id": 0, "id": 1, "chain_name": 1}))
+    return {str(chain["id"]): chain["chain_name"] for chain in chains}
+
 def get_chain_names():
     global chain_dict
-    chains = list(chains_collection.find({}, {"_id": 0, "id": 1, "chain_name": 1}))
-    chain_dict = {str(chain["id"]): chain["chain_name"] for chain in chains}
+    chain_dict = reference_cache.get("chains", load_chain_names)
+    return chain_dict
 
-def get_sub_chain_names():
-    global sub_chain_dict
+def load_sub_chain_names():
     sub_chains = list(sub_chains_collection.find({}, {"_id": 0, "chain_id": 1, "id": 1, "sub_chain_name": 1}))
-    sub_chain_dict = {}
+    chain_names = reference_cache.get("chains", load_chain_names)
+    sub_chain_names = {}
     for sub_chain in sub_chains:
         chain_id = str(sub_chain['chain_id'])
         sub_chain_id = str(sub_chain['id'])
@@ -51,89 +64,301 @@ def get_sub_chain_names():
         sub_chain_name = sub_chain.get('sub_chain_name', '')
         sub_chain_name = str(sub_chain_name or '').strip()
         if sub_chain_name == '1' or not sub_chain_name:
-            sub_chain_name = chain_dict.get(chain_id, 'Unknown Chain')
-        sub_chain_dict[key] = sub_chain_name
-    return sub_chain_dict
-
-def generate_canonical_barcode():
-    last_product = canonical_products_collection.find_one(sort=[("canonical_barcode", -1)])
-    if last_product:
-        return last_product["canonical_barcode"] + 1
-    else:
-        return 100001  # Starting point
-
-def extract_chain_and_sub_chain_id(file_name):
-    match = re.search(r'PriceFull(\d+)-(\d+)-', file_name)
-    if match:
-        chain_id = match.group(1)
-        sub_chain_id = match.group(2).lstrip('0') or '0'  # Remove leading zeros
-        return chain_id, sub_chain_id
-    else:
-        return None, None
+            sub_chain_name = chain_names.get(chain_id, 'Unknown Chain')
+        sub_chain_names[key] = sub_chain_name
+    return sub_chain_names
 
-def search_products(search_term, excluded_sub_chains, exclude_words=[]):
-    # Build regex pattern for exclude words
-    exclude_pattern = '|'.join([re.escape(word) for word in exclude_words])
-    # Query to search products
-    if exclude_words:
-        regex_pattern = f"^(?!.*({exclude_pattern})).*{re.escape(search_term)}.*"
-    else:
-        regex_pattern = f".*{re.escape(search_term)}.*"
+def get_sub_chain_names():
+    global sub_chain_dict
+    sub_chain_dict = reference_cache.get("sub_chains", load_sub_chain_names)
+    return sub_chain_dict
 
-    regex_query = {"$regex": regex_pattern, "$options": "i"}
+def get_barcode_allocator():
+    # Each session reserves its own block of barcodes (see barcodes.py)
+    if 'barcode_allocator' not in st.session_state:
+        st.session_state['barcode_allocator'] = BarcodeAllocator(counters_collection, canonical_products_collection)
+    return st.session_state['barcode_allocator']
 
-    query = {"item_name": regex_query}
+def generate_canonical_barcode():
+    # The session's next reserved barcode; it is only consumed once a product is saved with it
+    return get_barcode_allocator().peek()
+
+def find_products_mongo(search_term, excluded_sub_chains=(), exclude_words=[], limit=500, sub_chain_key=None):
+    # The search term is compiled into an index-friendly filter; the substring
+    # match and exclude words are checked on the candidates in a single pass
+    # (see query_plan.py)
+    plan = compile_query(search_term, exclude_words)
+    query = dict(plan.filter)
+    if sub_chain_key is not None:
+        # A key, or a condition such as {"$exists": False}
+        query["sub_chain_key"] = sub_chain_key
+    elif excluded_sub_chains:
+        # Products without sub_chain_key (not yet backfilled) still match and
+        # are filtered by search_products
+        query["sub_chain_key"] = {"$nin": list(excluded_sub_chains)}
     projection = {
         "_id": 0,
         "item_code": 1,
         "item_name": 1,
         "manufacturer_name": 1,
-        "file_name": 1
+        "file_name": 1,
+        "sub_chain_key": 1
     }
-    products_cursor = products_collection.find(query, projection).limit(500)
+    cursor = products_collection.find(query, projection)
+    products = []
+    for product in cursor.batch_size(limit):
+        if plan.accepts(product.get('item_name')):
+            products.append(product)
+            if len(products) >= limit:
+                break
+    cursor.close()
+    return products
+
+def get_search_backend():
+    # A local products snapshot when PRODUCTS_SNAPSHOT is set (see snapshot.py),
+    # otherwise the in-memory n-gram index
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        return snapshot
+    return get_search_index(products_collection)
+
+def find_products(search_term, excluded_sub_chains=(), exclude_words=[], limit=500):
+    # Serve from the snapshot or the in-memory index when it is built,
+    # otherwise fall back to the regex scan in Mongo
+    index = get_search_backend()
+    if index.ready:
+        try:
+            index.maybe_refresh()
+            return index.search(search_term, excluded_sub_chains, exclude_words, limit=limit)
+        except Exception:
+            pass
+    return find_products_mongo(search_term, excluded_sub_chains, exclude_words, limit=limit)
+
+def find_products_per_sub_chain(search_term, sub_chain_ids, excluded_sub_chains=(), exclude_words=[], per_sub_chain=20):
+    # The per_sub_chain closest matches from every sub-chain in sub_chain_ids.
+    # The Mongo path runs one bounded query per sub-chain concurrently, so the
+    # total latency is about that of the slowest sub-chain.
+    index = get_search_backend()
+    if index.ready:
+        try:
+            index.maybe_refresh()
+            return index.search(search_term, excluded_sub_chains, exclude_words, limit=None, per_sub_chain=per_sub_chain)
+        except Exception:
+            pass
+    executor = get_query_executor()
+    futures = [
+        executor.submit(tracing.bind(lambda key: find_sub_chain_candidates(search_term, key, exclude_words, per_sub_chain)), sub_chain_key)
+        for sub_chain_key in sub_chain_ids if sub_chain_key not in excluded_sub_chains
+    ]
+    # Products not backfilled yet have no sub_chain_key to query by; they are
+    # grouped by the sub-chain parsed from their file name
+    pending = executor.submit(tracing.bind(
+        lambda: list(find_products_mongo(search_term, (), exclude_words, SUB_CHAIN_CANDIDATES, {"$exists": False}))
+    ))
+    by_sub_chain = {}
+    for product in pending.result():
+        sub_chain_key = sub_chain_key_for(product.get('file_name', ''))
+        if sub_chain_key and sub_chain_key not in excluded_sub_chains:
+            by_sub_chain.setdefault(sub_chain_key, []).append(product)
+    products = [product for future in futures for product in future.result()]
+    for candidates in by_sub_chain.values():
+        products += closest_products(candidates, search_term, per_sub_chain)
+    return products
+
+def closest_products(products, search_term, k):
+    # The k products matching search_term most closely (see query_plan.candidate_rank)
+    unique = {}
+    for product in products:
+        unique.setdefault((product.get('item_code'), product.get('file_name')), product)
+    return heapq.nsmallest(k, unique.values(), key=lambda product: candidate_rank(product.get('item_name'), search_term))
+
+def find_sub_chain_candidates(search_term, sub_chain_key, exclude_words, per_sub_chain):
+    # The per_sub_chain closest matches of one sub-chain. Mongo returns matches
+    # in no useful order, so exact matches are looked up by name_key and ranked
+    # together with the first SUB_CHAIN_CANDIDATES matches of the search.
+    exclude_matcher = get_exclude_matcher(exclude_words)
+    projection = {"_id": 0, "item_code": 1, "item_name": 1, "manufacturer_name": 1, "file_name": 1, "sub_chain_key": 1}
+    exact = products_collection.find({"name_key": normalize_item_name(search_term), "sub_chain_key": sub_chain_key}, projection)
+    candidates = [
+        product for product in exact.limit(per_sub_chain)
+        if not (exclude_matcher and exclude_matcher.search(str(product.get('item_name') or '').lower()))
+    ]
+    candidates += find_products_mongo(search_term, (), exclude_words, SUB_CHAIN_CANDIDATES, sub_chain_key)
+    return closest_products(candidates, search_term, per_sub_chain)
+
+def annotate_product(product, search_term, excluded_sub_chains):
+    # Add sub_chain_id, chain_id and relevance to a product found for search_term.
+    # Returns None for products of excluded or unknown sub-chains and for
+    # products already mapped to a canonical product.
+    # Use the backfilled sub-chain key, parsing file_name only for products
+    # that have not been backfilled yet
+    sub_chain_key = product.pop('sub_chain_key', None) or sub_chain_key_for(product.get('file_name', ''))
+    if not sub_chain_key or sub_chain_key in excluded_sub_chains:
+        return None
+    # Skip items that are already mapped to a canonical product
+    if get_item_mappings(canonical_products_collection).owner(get_sub_chain_name(sub_chain_key), product.get('item_code')) is not None:
+        return None
+    product['sub_chain_id'] = sub_chain_key
+    product['chain_id'] = sub_chain_key.split('-')[0]  # Add chain_id to product
+    product['relevance'] = match_relevance(product['item_name'], search_term)
+    return product
+
+def search_products(search_term, excluded_sub_chains, exclude_words=[]):
+    products_cursor = find_products(search_term, excluded_sub_chains, exclude_words)
     products = []
     for product in products_cursor:
-        file_name = product.get('file_name', '')
-        chain_id, sub_chain_id = extract_chain_and_sub_chain_id(file_name)
-        if chain_id and sub_chain_id:
-            sub_chain_key = f"{chain_id}-{sub_chain_id}"
-            if sub_chain_key not in excluded_sub_chains:
-                product['sub_chain_id'] = sub_chain_key
-                product['chain_id'] = chain_id  # Add chain_id to product
-                # Compute relevance
-                item_name_lower = product['item_name'].lower()
-                search_term_lower = search_term.lower()
-                if item_name_lower == search_term_lower:
-                    relevance = 3
-                elif item_name_lower.startswith(search_term_lower):
-                    relevance = 2
-                elif search_term_lower in item_name_lower:
-                    relevance = 1
-                else:
-                    relevance = 0
-                product['relevance'] = relevance
-                products.append(product)
+        product = annotate_product(product, search_term, excluded_sub_chains)
+        if product is not None:
+            products.append(product)
     # Sort products by relevance in descending order
     products.sort(key=lambda x: x['relevance'], reverse=True)
     return products
 
+def search_products_per_sub_chain(search_term, sub_chain_ids, excluded_sub_chains, exclude_words=[], per_sub_chain=20):
+    # Fan-out search: the best products of every remaining sub-chain merged by
+    # relevance, so one large chain cannot crowd the smaller ones out of the results
+    by_sub_chain = {}
+    for product in find_products_per_sub_chain(search_term, sub_chain_ids, excluded_sub_chains, exclude_words, per_sub_chain):
+        product = annotate_product(product, search_term, excluded_sub_chains)
+        if product is not None:
+            by_sub_chain.setdefault(product['sub_chain_id'], []).append(product)
+    runs = [sorted(products, key=lambda x: x['relevance'], reverse=True) for products in by_sub_chain.values()]
+    return list(heapq.merge(*runs, key=lambda x: x['relevance'], reverse=True))
+
+def build_search_results(search_term, excluded_sub_chains, exclude_words):
+    # Search, rank and derive the display columns for the results selectbox.
+    # Returns the products, the results DataFrame (indexed by position in
+    # products) and the selectbox label for every index.
+    products = search_products_per_sub_chain(
+        search_term, sub_chain_dict.keys(), excluded_sub_chains, exclude_words, RESULTS_PER_SUB_CHAIN
+    )
+    if not products:
+        return products, pd.DataFrame(), {}
+    with tracing.span("rank_products"):
+        # Fuzzy-rank the candidates and keep the best ones per sub-chain
+        df_products = rank_products(search_term, pd.DataFrame(products), RESULTS_PER_SUB_CHAIN)
+        chain_names = df_products["chain_id"].astype(str).map(chain_dict)
+        df_products = df_products.assign(
+            chain_name=chain_names,
+            sub_chain_name=df_products["sub_chain_id"].map(sub_chain_dict).fillna(chain_names).fillna('Unknown Chain'),
+            item_display=df_products["item_name"].astype(str) + " (" + df_products["item_code"].astype(str) + ")"
+        )
+        df_products = df_products[["item_code", "item_name", "chain_name", "sub_chain_name", "manufacturer_name", "relevance", "score", "item_display"]]
+        labels = df_products["item_display"] + " - " + df_products["chain_name"].astype(str) + " - " + df_products["sub_chain_name"]
+    return products, df_products, labels.to_dict()
+
+def get_search_results(search_term, excluded_sub_chains, exclude_words):
+    key = (search_term, tuple(sorted(set(exclude_words))), frozenset(excluded_sub_chains))
+    return search_results_cache.get(key, lambda: build_search_results(search_term, excluded_sub_chains, exclude_words))
+
+def find_exact_products(name, excluded_sub_chains=()):
+    # Products whose normalized item_name equals the normalized name, from the
+    # snapshot or in-memory index when available or the indexed name_key field otherwise
+    index = get_search_backend()
+    if index.ready:
+        try:
+            return index.exact(name, excluded_sub_chains)
+        except Exception:
+            pass
+    query = {"name_key": normalize_item_name(name)}
+    if excluded_sub_chains:
+        query["sub_chain_key"] = {"$nin": list(excluded_sub_chains)}
+    projection = {
+        "_id": 0,
+        "item_code": 1,
+        "item_name": 1,
+        "manufacturer_name": 1,
+        "file_name": 1,
+        "sub_chain_key": 1
+    }
+    return products_collection.find(query, projection)
+
 def get_categories():
-    categories = canonical_products_collection.distinct("category")
-    return categories
+    categories = reference_cache.get("categories", lambda: canonical_products_collection.distinct("category"))
+    return list(categories)
 
 def get_sub_categories():
-    sub_categories = canonical_products_collection.distinct("sub_category")
-    return sub_categories
+    sub_categories = reference_cache.get("sub_categories", lambda: canonical_products_collection.distinct("sub_category"))
+    return list(sub_categories)
+
+def get_sub_chain_name(sub_chain_id):
+    return sub_chain_dict.get(sub_chain_id, chain_dict.get(sub_chain_id.split('-')[0], 'Unknown Chain'))
+
+def parse_category(category_data):
+    # Sheet categories are written as "Category - Sub-Category"
+    if pd.isnull(category_data):
+        return '', ''
+    category_data = str(category_data)
+    if '-' in category_data:
+        category, sub_category = map(str.strip, category_data.split('-', 1))
+    else:
+        category = category_data.strip()
+        sub_category = ''
+    return category, sub_category
+
+def parse_sheet_row(row):
+    # Canonical barcode (None when the sheet has none), category and sub-category of a sheet row
+    if 'Barcode' in row and pd.notnull(row['Barcode']):
+        barcode = int(row['Barcode'])
+    else:
+        barcode = None
+    if 'Category' in row:
+        category, sub_category = parse_category(row['Category'])
+    else:
+        category, sub_category = '', ''
+    return barcode, category, sub_category
+
+def find_exact_matches(name, excluded_sub_chains):
+    # Best exact match per sub-chain, used for auto-assignment. A product whose
+    # item_name equals the name as written beats one that only matches after
+    # normalization.
+    exact_matches = {}
+    for product in find_exact_products(name, excluded_sub_chains):
+        product = annotate_product(product, name, excluded_sub_chains)
+        if product is None:
+            continue
+        current = exact_matches.get(product['sub_chain_id'])
+        if current is None or (product['relevance'] > current['relevance']):
+            exact_matches[product['sub_chain_id']] = product
+    return exact_matches
+
+def build_canonical_product(canonical_barcode, name, category, sub_category, chain_barcodes):
+    created_at = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
+    return {
+        "canonical_barcode": canonical_barcode,
+        "name": name,
+        "category": category,
+        "sub_category": sub_category,
+        "chains": chain_barcodes,
+        "chain_items": chain_items(chain_barcodes),
+        "created_at": created_at
+    }
 
 def save_canonical_product(data):
+    # Returns whether the product was saved; failures are shown with st.error
+    conflicts = find_conflicts(canonical_products_collection, data["chains"])
+    if conflicts:
+        taken = ", ".join(f"{product['name']} ({product['canonical_barcode']})" for product in conflicts)
+        st.error(f"Some of the selected items are already mapped to: {taken}.")
+        return False
     try:
         canonical_products_collection.insert_one(data)
+        get_item_mappings(canonical_products_collection).add(data)
+        get_barcode_allocator().mark_used(data["canonical_barcode"])
+        # A saved product may introduce a new category or sub-category
+        reference_cache.invalidate("categories", "sub_categories")
+        invalidate_listings()
+        # Cached search results may list items that are now mapped
+        search_results_cache.clear()
         st.success("Canonical product saved successfully!")
+        return True
     except pymongo.errors.DuplicateKeyError:
         st.error("Canonical barcode already exists.")
+        return False
 
 def main():
     st.title("Canonical Product Builder")
+    tracing.section("Setup")
 
     # Initialize chain and sub-chain names
     get_chain_names()
@@ -165,42 +390,43 @@ def main():
     tab1, tab2 = st.tabs(["Build Canonical Product", "View Canonical Products"])
 
     with tab1:
-        # Input Google Sheets link
-        google_sheets_link = st.text_input("Enter Google Sheets URL")
-        if google_sheets_link:
-            # Extract the file ID
-            match = re.search(r'/d/([a-zA-Z0-9-_]+)', google_sheets_link)
-            if match:
-                file_id = match.group(1)
-                export_link = f'https://docs.google.com/spreadsheets/d/{file_id}/export?format=xlsx'
-
+        tracing.section("Load Sheet")
+        # Input Google Sheets link, or the path of a local .xlsx/.csv file
+        sheet_source = st.text_input("Enter Google Sheets URL or file path")
+        if sheet_source:
+            reload_sheet = st.button("Reload Sheet")
+            if is_url(sheet_source) and not google_sheet_export_link(sheet_source):
+                st.error("Invalid Google Sheets URL. Please ensure it follows the format: https://docs.google.com/spreadsheets/d/FILE_ID/edit")
+                st.session_state['uploaded_products'] = pd.DataFrame()
+            else:
                 try:
-                    response = requests.get(export_link)
-                    if response.status_code == 200:
-                        df_excel = pd.read_excel(BytesIO(response.content))
-                        if not df_excel.empty:
-                            # Store the DataFrame in session state
-                            st.session_state['uploaded_products'] = df_excel
-                            # Reset selected product name when new file is uploaded
+                    # Downloaded and parsed only when the sheet changes (see sheets.py)
+                    sheet = load_sheet(sheet_source, max_age=0 if reload_sheet else None)
+                    if not sheet.frame.empty:
+                        # Reset selected product name when a new or changed file is loaded
+                        if st.session_state.get('sheet_digest') != sheet.digest or st.session_state['uploaded_products'].empty:
+                            st.session_state['sheet_digest'] = sheet.digest
+                            st.session_state['uploaded_products'] = sheet.frame
                             st.session_state['selected_product_name'] = None
-                            st.success("Excel file loaded successfully.")
-                        else:
-                            st.error("The Google Sheet is empty.")
-                            st.session_state['uploaded_products'] = pd.DataFrame()
+                        st.success("Excel file loaded successfully.")
                     else:
-                        st.error("Failed to download the Google Sheet. Please check the link and try again.")
+                        st.error("The Google Sheet is empty.")
                         st.session_state['uploaded_products'] = pd.DataFrame()
+                except requests.RequestException:
+                    st.error("Failed to download the Google Sheet. Please check the link and try again.")
+                    st.session_state['uploaded_products'] = pd.DataFrame()
+                except FileNotFoundError:
+                    st.error(f"File not found: {sheet_source}")
+                    st.session_state['uploaded_products'] = pd.DataFrame()
                 except Exception as e:
                     st.error(f"Error reading Excel file: {e}")
                     st.session_state['uploaded_products'] = pd.DataFrame()
-            else:
-                st.error("Invalid Google Sheets URL. Please ensure it follows the format: https://docs.google.com/spreadsheets/d/FILE_ID/edit")
-                st.session_state['uploaded_products'] = pd.DataFrame()
         else:
             st.session_state['uploaded_products'] = pd.DataFrame()
 
         # Section 1: Create Canonical Product
         st.header("1. Create Canonical Product")
+        tracing.section("1. Create Canonical Product")
 
         # Input name, category, and sub-category
         if not st.session_state['uploaded_products'].empty:
@@ -220,22 +446,12 @@ def main():
                     selected_product = st.session_state['uploaded_products'][st.session_state['uploaded_products']['Name'] == selected_product_name].iloc[0]
                     name = selected_product_name
                     st.session_state['name'] = name
-                    # Update canonical barcode if available
-                    if 'Barcode' in selected_product and pd.notnull(selected_product['Barcode']):
-                        st.session_state["canonical_barcode"] = int(selected_product['Barcode'])
+                    # Update canonical barcode, category and sub-category if available
+                    barcode, category, sub_category = parse_sheet_row(selected_product)
+                    if barcode is not None:
+                        st.session_state["canonical_barcode"] = barcode
                     else:
                         st.session_state["canonical_barcode"] = generate_canonical_barcode()
-                    # Update category and sub-category if available
-                    if 'Category' in selected_product and pd.notnull(selected_product['Category']):
-                        category_data = selected_product['Category']
-                        if '-' in category_data:
-                            category, sub_category = map(str.strip, category_data.split('-', 1))
-                        else:
-                            category = category_data.strip()
-                            sub_category = ''
-                    else:
-                        category = ''
-                        sub_category = ''
                     # Store category and sub-category in session state
                     st.session_state['category'] = category
                     st.session_state['sub_category'] = sub_category
@@ -289,12 +505,15 @@ def main():
 
         # Section 2: Auto-Suggestion for Matching Products
         st.header("2. Auto-Suggestion for Matching Products")
-        if name:
-            auto_products = search_products(f"^{re.escape(name)}$", st.session_state['excluded_sub_chains'])
-            if auto_products:
+        tracing.section("2. Auto-Suggestion for Matching Products")
+        # Auto-assign once per product name, so items the operator removes in
+        # Section 4 are not assigned again on the next rerun
+        if name and st.session_state.get('auto_assigned_name') != name:
+            st.session_state['auto_assigned_name'] = name
+            auto_matches = find_exact_matches(name, st.session_state['excluded_sub_chains'])
+            if auto_matches:
                 exact_matches = {}
-                for product in auto_products:
-                    sub_chain_id = product['sub_chain_id']
+                for sub_chain_id, product in auto_matches.items():
                     if sub_chain_id not in st.session_state['selected_sub_chains']:
                         st.session_state['selected_sub_chains'].add(sub_chain_id)
                         st.session_state['excluded_sub_chains'].add(sub_chain_id)
@@ -307,6 +526,7 @@ def main():
 
         # Section 3: Search for Products
         st.header("3. Search for Products")
+        tracing.section("3. Search for Products")
 
         search_term = st.text_input("Search for products", value=name, key='search_term_input')
         exclude_words_input = st.text_input("Exclude words from search (separate by commas)", key='exclude_words_input')
@@ -324,20 +544,15 @@ def main():
             exclude_words = []
 
         if search_term:
-            products = search_products(search_term, st.session_state['excluded_sub_chains'], exclude_words)
+            products, df_products, option_labels = get_search_results(
+                search_term, st.session_state['excluded_sub_chains'], exclude_words
+            )
             if products:
-                df_products = pd.DataFrame(products)
-                df_products["sub_chain_name"] = df_products["sub_chain_id"].apply(
-                    lambda x: sub_chain_dict.get(x, chain_dict.get(x.split('-')[0], 'Unknown Chain'))
-                )
-                df_products["chain_name"] = df_products["chain_id"].astype(str).map(chain_dict)
-                df_products = df_products[["item_code", "item_name", "chain_name", "sub_chain_name", "manufacturer_name", "relevance"]]
-                df_products["item_display"] = df_products.apply(lambda x: f"{x['item_name']} ({x['item_code']})", axis=1)
                 st.write("Search Results:")
                 selected_index = st.selectbox(
                     "Select a product to assign",
                     options=df_products.index,
-                    format_func=lambda x: f"{df_products.loc[x, 'item_display']} - {df_products.loc[x, 'chain_name']} - {df_products.loc[x, 'sub_chain_name']}",
+                    format_func=option_labels.__getitem__,
                     key='product_assign_selectbox'
                 )
                 if st.button("Assign Selected Product"):
@@ -358,13 +573,14 @@ def main():
 
         # Section 4: Selected Products from Sub-Chains
         st.header("4. Selected Products from Sub-Chains")
+        tracing.section("4. Selected Products from Sub-Chains")
         chain_barcodes = {}
 
         with st.form("remove_items_form"):
             st.write("Select items to remove:")
             remove_sub_chains = []
             for sub_chain_id, item in st.session_state['selected_items'].items():
-                sub_chain_name = sub_chain_dict.get(sub_chain_id, chain_dict.get(sub_chain_id.split('-')[0], 'Unknown Chain'))
+                sub_chain_name = get_sub_chain_name(sub_chain_id)
                 chain_barcodes[sub_chain_name] = item["item_code"]
                 col1, col2, col3 = st.columns([4, 4, 1])
                 with col1:
@@ -404,20 +620,15 @@ def main():
 
         # Section 5: Preview and Save
         st.header("5. Preview and Save")
+        tracing.section("5. Preview and Save")
 
         if st.button("Preview Canonical Product"):
             if not name or not category or not chain_barcodes:
                 st.error("Please ensure that Name, Category, and Sub-Chain-Specific Barcodes are provided.")
             else:
-                created_at = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
-                canonical_product = {
-                    "canonical_barcode": st.session_state["canonical_barcode"],
-                    "name": name,
-                    "category": category,
-                    "sub_category": sub_category,
-                    "chains": chain_barcodes,
-                    "created_at": created_at
-                }
+                canonical_product = build_canonical_product(
+                    st.session_state["canonical_barcode"], name, category, sub_category, chain_barcodes
+                )
                 st.write("Canonical Product Preview:")
                 st.json(canonical_product)
 
@@ -426,10 +637,9 @@ def main():
                     existing = canonical_products_collection.find_one({"canonical_barcode": st.session_state["canonical_barcode"]})
                     if existing:
                         st.error("Canonical barcode already exists.")
-                    else:
-                        save_canonical_product(canonical_product)
+                    elif save_canonical_product(canonical_product):
                         # Reset session state
-                        st.session_state["canonical_barcode"] += 1
+                        st.session_state["canonical_barcode"] = generate_canonical_barcode()
                         st.session_state['selected_sub_chains'] = set()
                         st.session_state['selected_items'] = {}
                         st.session_state['excluded_sub_chains'] = set()
@@ -438,27 +648,54 @@ def main():
                         st.session_state['name'] = ''
                         st.session_state['category'] = ''
                         st.session_state['sub_category'] = ''
-                        st.experimental_rerun()
+                        st.session_state.pop('auto_assigned_name', None)
+                        st.rerun()
 
     with tab2:
         st.header("View Existing Canonical Products")
-        canonical_products = list(canonical_products_collection.find({}, {"_id": 0, "canonical_barcode": 1, "name": 1}))
+        tracing.section("View Existing Canonical Products")
+        browse_search = st.text_input("Search by name, category or sub-category", key='browse_search_input').strip()
+        # Keyset pagination: the stack holds the last barcode of every previous page
+        if st.session_state.get('browse_prev_search') != browse_search:
+            st.session_state['browse_prev_search'] = browse_search
+            st.session_state['browse_cursors'] = [None]
+        cursors = st.session_state['browse_cursors']
+        canonical_products, has_more = list_canonical_products(
+            canonical_products_collection, browse_search, cursors[-1], BROWSE_PAGE_SIZE
+        )
+        col1, col2 = st.columns(2)
+        with col1:
+            if len(cursors) > 1 and st.button("Previous Page"):
+                cursors.pop()
+                st.rerun()
+        with col2:
+            if has_more and st.button("Next Page"):
+                cursors.append(canonical_products[-1]['canonical_barcode'])
+                st.rerun()
         if canonical_products:
-            df_canonical = pd.DataFrame(canonical_products)
-            df_canonical['display'] = df_canonical.apply(lambda x: f"{x['name']} ({x['canonical_barcode']})", axis=1)
-            selected_product = st.selectbox("Select a canonical product", options=df_canonical.index, format_func=lambda x: df_canonical.loc[x, 'display'])
-            product = canonical_products[selected_product]
-            st.write(f"**Name:** {product['name']}")
-            st.write(f"**Canonical Barcode:** {product['canonical_barcode']}")
-            st.write(f"**Category:** {product.get('category', '')}")
-            st.write(f"**Sub-Category:** {product.get('sub_category', '')}")
-            st.write(f"**Created At:** {product.get('created_at', '')}")
-            st.write("**Chains:**")
-            chains = product.get('chains', {})
-            for chain_name, item_code in chains.items():
-                st.write(f"- {chain_name}: {item_code}")
+            st.write(f"Page {len(cursors)}")
+            display_names = {product['canonical_barcode']: f"{product['name']} ({product['canonical_barcode']})" for product in canonical_products}
+            selected_barcode = st.selectbox(
+                "Select a canonical product",
+                options=list(display_names),
+                format_func=display_names.get,
+                key='canonical_product_selectbox'
+            )
+            # Fetch the full document, including chains, only for the selected product
+            product = get_canonical_product(canonical_products_collection, selected_barcode)
+            if product:
+                st.write(f"**Name:** {product['name']}")
+                st.write(f"**Canonical Barcode:** {product['canonical_barcode']}")
+                st.write(f"**Category:** {product.get('category', '')}")
+                st.write(f"**Sub-Category:** {product.get('sub_category', '')}")
+                st.write(f"**Created At:** {product.get('created_at', '')}")
+                st.write("**Chains:**")
+                chains = product.get('chains', {})
+                for chain_name, item_code in chains.items():
+                    st.write(f"- {chain_name}: {item_code}")
         else:
             st.write("No canonical products found.")
 
 if __name__ == "__main__":
-    main()
+    with tracing.rerun():
+        main()
@@ -0,0 +1,113 @@
+import threading
+
+import pymongo
+from pymongo import ReturnDocument
+
+from db import on_client_change
+
+# Canonical barcode allocation.
+#
+# The next free barcode lives in a counter document ({"_id": "canonical_barcode",
+# "next": <int>}) that is advanced with a single atomic find_one_and_update.
+# Each allocator reserves a block of barcodes at a time, so concurrent sessions
+# and batch jobs never hand out the same barcode and allocation costs one write
+# per block.
+
+FIRST_CANONICAL_BARCODE = 100001
+COUNTER_ID = "canonical_barcode"
+
+_seeded = set()
+_seed_lock = threading.Lock()
+
+
+def forget_seeded_counters():
+    # Counters are seeded again after a switch to another database
+    with _seed_lock:
+        _seeded.clear()
+
+
+on_client_change(forget_seeded_counters)
+
+
+def seed_barcode_counter(counters_collection, canonical_collection, counter_id=COUNTER_ID):
+    # Create the counter from the highest existing barcode the first time it is
+    # needed. $max keeps this safe when several processes seed concurrently.
+    with _seed_lock:
+        if counter_id in _seeded:
+            return
+        if counters_collection.find_one({"_id": counter_id}) is None:
+            last_product = canonical_collection.find_one(
+                {}, {"_id": 0, "canonical_barcode": 1}, sort=[("canonical_barcode", -1)]
+            )
+            start = last_product["canonical_barcode"] + 1 if last_product else FIRST_CANONICAL_BARCODE
+            try:
+                counters_collection.update_one({"_id": counter_id}, {"$max": {"next": start}}, upsert=True)
+            except pymongo.errors.DuplicateKeyError:
+                pass  # Another process created it first
+        try:
+            canonical_collection.create_index([("canonical_barcode", pymongo.ASCENDING)], unique=True)
+        except pymongo.errors.OperationFailure:
+            pass  # Existing duplicates; inserts are still checked before saving
+        _seeded.add(counter_id)
+
+
+class BarcodeAllocator:
+    def __init__(self, counters_collection, canonical_collection, block_size=10, counter_id=COUNTER_ID):
+        self.counters = counters_collection
+        self.canonical = canonical_collection
+        self.block_size = block_size
+        self.counter_id = counter_id
+        self._next = 0
+        self._end = 0
+        self._used = set()  # barcodes of the block saved ahead of _next
+
+    def reserve(self, count):
+        # Atomically reserve `count` consecutive barcodes and return them as a range.
+        # The counter is never upserted here: a counter created by $inc would
+        # start from 0, so a missing one (e.g. a dropped collection) is seeded again.
+        seed_barcode_counter(self.counters, self.canonical, self.counter_id)
+        while True:
+            counter = self.counters.find_one_and_update(
+                {"_id": self.counter_id},
+                {"$inc": {"next": count}},
+                return_document=ReturnDocument.AFTER
+            )
+            if counter is not None:
+                break
+            with _seed_lock:
+                _seeded.discard(self.counter_id)
+            seed_barcode_counter(self.counters, self.canonical, self.counter_id)
+        end = counter["next"]
+        return range(end - count, end)
+
+    def peek(self):
+        # Next free barcode from the reserved block, reserving a new block when it runs out
+        while True:
+            if self._next >= self._end:
+                block = self.reserve(self.block_size)
+                self._next, self._end = block.start, block.stop
+                self._used.clear()
+            if self._next not in self._used:
+                return self._next
+            self._next += 1
+
+    def allocate(self):
+        barcode = self.peek()
+        self._next += 1
+        return barcode
+
+    def mark_used(self, *barcodes):
+        # Called after products are saved. Barcodes from our block are consumed
+        # (or skipped later when saved out of order); barcodes typed in or taken
+        # from a sheet push the counter past them so later blocks cannot collide
+        # with them.
+        highest = None
+        for barcode in sorted(barcodes):
+            if barcode == self._next and self._next < self._end:
+                self._next += 1
+            elif self._next < barcode < self._end:
+                self._used.add(barcode)
+            else:
+                highest = barcode
+        if highest is not None:
+            self.counters.update_one({"_id": self.counter_id}, {"$max": {"next": highest + 1}})
@@ -0,0 +1,342 @@
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from itertools import accumulate
+
+import streamlit as st
+
+# Benchmarks for the builder's hot paths on synthetic data.
+#
+# Generates chains, sub_chains, products and canonical_products at a given
+# scale (Hebrew-like item names, PriceFull file names, a Zipf-like word
+# distribution so some searches hit many products and some hit few), loads them
+# into mongomock or a local mongod, and times the functions app.py calls on a
+# rerun. Each scenario reports p50/p95 latency and the peak Python memory
+# allocated by one call. Results can be saved and used as the baseline of a
+# later run, which then fails when a scenario got slower or hungrier than the
+# tolerance allows.
+#
+#   python bench.py --scale 100k --output baseline.json
+#   python bench.py --scale 100k --baseline baseline.json
+#   python bench.py --scale 1m --mongo-uri mongodb://localhost:27017
+
+SCALES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+BENCH_DATABASE = "canonical_bench"
+INSERT_BATCH = 10_000
+
+HEBREW_LETTERS = "אבגדהוזחטיכלמנסעפצקרשת"
+HEBREW_FINAL_FORMS = {"כ": "ך", "מ": "ם", "נ": "ן", "פ": "ף", "צ": "ץ"}
+UNITS = ["גרם", 'ק"ג', "ליטר", 'מ"ל', "יח'"]
+PRICE_FILE_DATES = ["202410010000", "202410080000", "202410150000"]
+
+
+def hebrew_word(rnd):
+    letters = [rnd.choice(HEBREW_LETTERS) for _ in range(rnd.randint(2, 7))]
+    letters[-1] = HEBREW_FINAL_FORMS.get(letters[-1], letters[-1])
+    return "".join(letters)
+
+
+class SyntheticCatalog:
+    def __init__(self, products, seed=1, chains=10, vocabulary=3000):
+        self.rnd = rnd = random.Random(seed)
+        self.products = products
+        self.words = list(dict.fromkeys(hebrew_word(rnd) for _ in range(vocabulary)))
+        # Zipf-like: the i-th word is about i times rarer than the first
+        self.word_weights = list(accumulate(1 / (i + 1) for i in range(len(self.words))))
+        self.brands = [hebrew_word(rnd) for _ in range(200)]
+        self.chains = []
+        self.sub_chains = []
+        for chain_number in range(1, chains + 1):
+            chain_id = 7290000000000 + chain_number
+            chain_name = f"רשת {hebrew_word(rnd)}"
+            self.chains.append({"id": chain_id, "chain_name": chain_name})
+            for sub_chain_id in range(1, rnd.randint(2, 20) + 1):
+                self.sub_chains.append({
+                    "chain_id": chain_id,
+                    "id": sub_chain_id,
+                    "sub_chain_name": f"{chain_name} {hebrew_word(rnd)} {sub_chain_id}"
+                })
+        # Each item is sold by several sub-chains, so products repeat item codes
+        self.items = [self.item(i) for i in range(max(products // 4, 1))]
+        self.categories = [
+            (hebrew_word(rnd), [hebrew_word(rnd) for _ in range(rnd.randint(0, 5))]) for _ in range(30)
+        ]
+
+    def word(self):
+        return self.rnd.choices(self.words, cum_weights=self.word_weights)[0]
+
+    def item(self, number):
+        rnd = self.rnd
+        words = [self.word() for _ in range(rnd.randint(1, 3))]
+        if rnd.random() < 0.5:
+            words.append(rnd.choice(self.brands))
+        if rnd.random() < 0.6:
+            words.append(f"{rnd.choice([1, 2, 6, 100, 200, 250, 500, 750])} {rnd.choice(UNITS)}")
+        return {
+            "item_code": str(7290100000000 + number),
+            "item_name": " ".join(words),
+            "manufacturer_name": rnd.choice(self.brands)
+        }
+
+    def product_documents(self, backfilled=True):
+        from catalog import extract_chain_and_sub_chain_id, name_suffixes, normalize_item_name
+
+        rnd = self.rnd
+        for _ in range(self.products):
+            item = rnd.choice(self.items)
+            sub_chain = rnd.choice(self.sub_chains)
+            file_name = f"PriceFull{sub_chain['chain_id']}-{sub_chain['id']:03d}-{rnd.choice(PRICE_FILE_DATES)}.gz"
+            product = dict(item, item_price=f"{rnd.uniform(1, 80):.2f}", file_name=file_name)
+            if backfilled:
+                # The fields catalog.py's backfills would add
+                chain_id, sub_chain_id = extract_chain_and_sub_chain_id(file_name)
+                product.update(
+                    chain_id=chain_id,
+                    sub_chain_id=sub_chain_id,
+                    sub_chain_key=f"{chain_id}-{sub_chain_id}",
+                    name_key=normalize_item_name(item["item_name"]),
+                    name_suffixes=name_suffixes(item["item_name"])
+                )
+            yield product
+
+    def canonical_documents(self):
+        from mappings import chain_items
+
+        rnd = self.rnd
+        created_at = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
+        for number, item in enumerate(self.items[:max(self.products // 100, 10)]):
+            category, sub_categories = rnd.choice(self.categories)
+            chains = {
+                sub_chain["sub_chain_name"]: item["item_code"]
+                for sub_chain in rnd.sample(self.sub_chains, rnd.randint(1, 5))
+            }
+            yield {
+                "canonical_barcode": 100001 + number,
+                "name": item["item_name"],
+                "category": category,
+                "sub_category": rnd.choice(sub_categories) if sub_categories else '',
+                "chains": chains,
+                "chain_items": chain_items(chains),
+                "created_at": created_at
+            }
+
+
+def insert_batches(collection, documents):
+    batch = []
+    for document in documents:
+        batch.append(document)
+        if len(batch) >= INSERT_BATCH:
+            collection.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
+
+
+def load_catalog(catalog, mongo_uri=None, database=BENCH_DATABASE, backfilled=True):
+    # Point db.py at a fresh benchmark database and fill it
+    import db
+    from catalog import ensure_product_indexes
+    from mappings import ensure_mapping_indexes
+
+    if mongo_uri:
+        import pymongo
+        client = pymongo.MongoClient(mongo_uri)
+        client.drop_database(database)
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("mongomock is not installed; pip install mongomock or pass --mongo-uri.")
+        client = mongomock.MongoClient()
+    db.set_mongo_client(client, database)
+    collections = db.get_database()
+    collections["chains"].insert_many(catalog.chains)
+    collections["sub_chains"].insert_many(catalog.sub_chains)
+    insert_batches(collections["products"], catalog.product_documents(backfilled))
+    insert_batches(collections["canonical_products"], catalog.canonical_documents())
+    ensure_product_indexes(collections["products"])
+    ensure_mapping_indexes(collections["canonical_products"])
+
+
+def percentile(values, percent):
+    # Nearest-rank percentile of a sorted list
+    return values[max(math.ceil(percent / 100 * len(values)) - 1, 0)]
+
+
+def measure(name, fn, calls, setup=None):
+    # Time fn(*args) for every args in calls; setup runs untimed before each call
+    if setup:
+        setup()
+    fn(*calls[0])  # warm-up (lazy loads, connection pool)
+    timings = []
+    for args in calls:
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn(*args)
+        timings.append((time.perf_counter() - start) * 1000)
+    if setup:
+        setup()
+    tracemalloc.start()
+    fn(*calls[0])
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    timings.sort()
+    return {
+        "name": name,
+        "calls": len(timings),
+        "p50_ms": round(percentile(timings, 50), 3),
+        "p95_ms": round(percentile(timings, 95), 3),
+        "peak_kib": round(peak / 1024, 1)
+    }
+
+
+def max_rss_mib():
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def run_benchmarks(catalog, repeat=30, search_modes=("mongo", "index")):
+    import app
+    from browse import invalidate_listings, list_canonical_products
+    from db import reference_cache
+    from search_index import get_search_index
+
+    rnd = random.Random(2)
+    app.get_chain_names()
+    app.get_sub_chain_names()
+    sub_chain_keys = list(app.sub_chain_dict)
+    # Common words hit thousands of products, rarer ones a handful
+    terms = [catalog.words[rnd.randint(0, 50)] if i % 2 else rnd.choice(catalog.words) for i in range(repeat)]
+    excludes = [
+        ({rnd.choice(sub_chain_keys)}, [catalog.words[rnd.randint(0, 20)], rnd.choice(catalog.brands)])
+        for _ in range(repeat)
+    ]
+    names = [rnd.choice(catalog.items)["item_name"] for _ in range(repeat)]
+    canonical_count = max(catalog.products // 100, 10)
+    afters = [100001 + rnd.randrange(canonical_count) for _ in range(repeat)]
+    categories = [rnd.choice(catalog.categories)[0] for _ in range(repeat)]
+
+    results = []
+    for mode in search_modes:
+        if mode == "index":
+            started = time.perf_counter()
+            get_search_index(app.products_collection).build()
+            print(f"Built the search index in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+        results.append(measure(f"search_products[{mode}]", app.search_products, [(term, set(), []) for term in terms]))
+        results.append(measure(
+            f"search_products_exclude[{mode}]", app.search_products,
+            [(term, excluded, words) for term, (excluded, words) in zip(terms, excludes)]
+        ))
+        results.append(measure(f"search_results[{mode}]", app.build_search_results, [(term, set(), []) for term in terms]))
+        results.append(measure(f"auto_suggestion[{mode}]", app.find_exact_matches, [(name, set()) for name in names]))
+
+    results.append(measure(
+        "generate_canonical_barcode", app.generate_canonical_barcode, [()] * repeat,
+        setup=lambda: st.session_state.pop('barcode_allocator', None)  # a new session reserves a block
+    ))
+    results.append(measure(
+        "category_distincts", lambda: (app.get_categories(), app.get_sub_categories()), [()] * repeat,
+        setup=lambda: reference_cache.invalidate("categories", "sub_categories")
+    ))
+    results.append(measure(
+        "browse_first_page", list_canonical_products,
+        [(app.canonical_products_collection, None, None, app.BROWSE_PAGE_SIZE)] * repeat, setup=invalidate_listings
+    ))
+    results.append(measure(
+        "browse_later_page", list_canonical_products,
+        [(app.canonical_products_collection, None, after, app.BROWSE_PAGE_SIZE) for after in afters],
+        setup=invalidate_listings
+    ))
+    results.append(measure(
+        "browse_search", list_canonical_products,
+        [(app.canonical_products_collection, category, None, app.BROWSE_PAGE_SIZE) for category in categories],
+        setup=invalidate_listings
+    ))
+    return results
+
+
+def find_regressions(results, baseline, tolerance=0.25, min_delta_ms=1.0, min_delta_kib=256):
+    # Scenarios whose p95 latency or peak memory grew past the tolerance
+    previous = {result["name"]: result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = previous.get(result["name"])
+        if before is None:
+            continue
+        latency = result["p95_ms"] - before["p95_ms"]
+        if latency > min_delta_ms and result["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{result['name']}: p95 {before['p95_ms']:.1f} -> {result['p95_ms']:.1f} ms")
+        memory = result["peak_kib"] - before["peak_kib"]
+        if memory > min_delta_kib and result["peak_kib"] > before["peak_kib"] * (1 + tolerance):
+            regressions.append(f"{result['name']}: peak {before['peak_kib']:.0f} -> {result['peak_kib']:.0f} KiB")
+    return regressions
+
+
+def print_results(results):
+    print(f"{'scenario':<36} {'calls':>5} {'p50 ms':>9} {'p95 ms':>9} {'peak KiB':>10}")
+    for result in results:
+        print(f"{result['name']:<36} {result['calls']:>5} {result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} {result['peak_kib']:>10.0f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the builder's hot paths on synthetic data.")
+    parser.add_argument("--scale", choices=SCALES, default="10k", help="number of products (default: 10k)")
+    parser.add_argument("--mongo-uri", help="local mongod to load the data into (default: in-process mongomock)")
+    parser.add_argument("--database", default=BENCH_DATABASE, help=f"database to (re)create (default: {BENCH_DATABASE})")
+    parser.add_argument("--repeat", type=int, default=30, help="timed calls per scenario (default: 30)")
+    parser.add_argument("--search", choices=["mongo", "index", "both"], default="both", help="search backends to time")
+    parser.add_argument("--raw", action="store_true", help="load products without the backfilled fields")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the results as JSON (usable as a later --baseline)")
+    parser.add_argument("--baseline", help="results JSON of an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed growth over the baseline (default: 0.25)")
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.WARNING)  # Streamlit warns about running without a script context
+    # Searches go to MongoDB until the benchmark builds the index itself
+    os.environ["SEARCH_INDEX"] = "0"
+    os.environ.pop("PRODUCTS_SNAPSHOT", None)
+
+    started = time.perf_counter()
+    catalog = SyntheticCatalog(SCALES[args.scale], seed=args.seed)
+    load_catalog(catalog, args.mongo_uri, args.database, backfilled=not args.raw)
+    print(f"Loaded {catalog.products} products in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+    search_modes = ("mongo", "index") if args.search == "both" else (args.search,)
+    results = run_benchmarks(catalog, args.repeat, search_modes)
+    print_results(results)
+    report = {
+        "scale": args.scale,
+        "backend": "mongod" if args.mongo_uri else "mongomock",
+        "raw": args.raw,
+        "max_rss_mib": max_rss_mib(),
+        "results": results
+    }
+    print(f"max RSS: {report['max_rss_mib']} MiB")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
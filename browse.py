@@ -0,0 +1,47 @@
+import re
+
+import pymongo
+
+from db import LRUCache
+
+# Paginated browsing of canonical_products for the "View Canonical Products" tab.
+#
+# Pages use keyset pagination on canonical_barcode (unique index), so fetching
+# any page costs one bounded, indexed query no matter how many products exist.
+# Listings carry only the summary fields; a product's chains are fetched when
+# it is selected. Listing pages are cached and cleared when a product is saved.
+
+LISTING_PROJECTION = {"_id": 0, "canonical_barcode": 1, "name": 1, "category": 1, "sub_category": 1}
+SEARCH_FIELDS = ["name", "category", "sub_category"]
+
+# Bounded, so every distinct search string and page cursor cannot grow it forever
+listing_cache = LRUCache(maxsize=256, ttl=300)
+
+
+def browse_query(search=None, after=None):
+    query = {}
+    if after is not None:
+        query["canonical_barcode"] = {"$gt": after}
+    if search:
+        pattern = {"$regex": re.escape(search), "$options": "i"}
+        query["$or"] = [{field: pattern} for field in SEARCH_FIELDS]
+    return query
+
+
+def list_canonical_products(canonical_collection, search=None, after=None, page_size=50):
+    # One page of products with canonical_barcode > after, plus whether more follow
+    def load():
+        cursor = canonical_collection.find(browse_query(search, after), LISTING_PROJECTION)
+        products = list(cursor.sort("canonical_barcode", pymongo.ASCENDING).limit(page_size + 1))
+        return products[:page_size], len(products) > page_size
+
+    products, has_more = listing_cache.get((search or '', after, page_size), load)
+    return list(products), has_more
+
+
+def get_canonical_product(canonical_collection, canonical_barcode):
+    return canonical_collection.find_one({"canonical_barcode": canonical_barcode}, {"_id": 0})
+
+
+def invalidate_listings():
+    listing_cache.clear()
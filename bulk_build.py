@@ -0,0 +1,231 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import InsertOne
+from pymongo.errors import BulkWriteError
+
+import app
+from barcodes import BarcodeAllocator
+from mappings import find_item_owners, get_item_mappings
+import sheets
+
+# Headless version of the "Build Canonical Product" tab.
+#
+# Every row of the sheet goes through the same steps an operator does in the
+# UI: parse Barcode/Category, auto-assign exact matches per sub-chain, save.
+# Rows that the exact-match step cannot complete are written to a review CSV
+# for a human. Finished rows are appended to a state file after their batch is
+# written, so an interrupted run resumes where it stopped.
+#
+#   python bulk_build.py <google sheets url | sheet.xlsx | sheet.csv>
+
+REVIEW_FIELDS = ["row", "name", "canonical_barcode", "category", "sub_category", "reason", "matches"]
+
+
+def load_sheet(source):
+    # Only the Name/Barcode/Category columns are parsed (see sheets.py)
+    return sheets.load_sheet(source, max_age=0).frame
+
+
+def sheet_rows(df):
+    # Same rows the UI offers in "Select Product": unique, non-empty names
+    df = df[df['Name'].notna()].drop_duplicates('Name')
+    for index, row in df.iterrows():
+        yield int(index), row
+
+
+def load_finished(state_file):
+    finished = set()
+    if os.path.exists(state_file):
+        with open(state_file, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    finished.add(json.loads(line)["name"])
+    return finished
+
+
+def process_row(row_number, row):
+    name = str(row['Name']).strip()
+    try:
+        barcode, category, sub_category = app.parse_sheet_row(row)
+    except (TypeError, ValueError):
+        # e.g. "N/A" in the Barcode column; the row goes to review instead of
+        # aborting the run
+        return {
+            "row": row_number,
+            "name": name,
+            "canonical_barcode": None,
+            "category": '',
+            "sub_category": '',
+            "matches": {},
+            "error": f"invalid barcode: {row.get('Barcode')}"
+        }
+    return {
+        "row": row_number,
+        "name": name,
+        "canonical_barcode": barcode,
+        "category": category,
+        "sub_category": sub_category,
+        "matches": app.find_exact_matches(name, set())
+    }
+
+
+class BulkBuilder:
+    def __init__(self, review_file, state_file, batch_size=200, min_chains=1):
+        self.review_file = review_file
+        self.state_file = state_file
+        self.batch_size = batch_size
+        self.min_chains = min_chains
+        self.allocator = BarcodeAllocator(app.counters_collection, app.canonical_products_collection, block_size=batch_size)
+        self.saved = 0
+        self.review = 0
+        self._documents = []
+        self._reviews = []
+        self._finished = []
+        # Chain items of the rows saved or queued in this run; the in-process
+        # mappings only learn about them after their batch is written
+        self._claimed = set()
+
+    def handle(self, result):
+        if result.get("error"):
+            self._add_review(result, result["error"])
+        elif not result["category"]:
+            self._add_review(result, "missing category")
+        elif len(result["matches"]) < self.min_chains:
+            self._add_review(result, "no exact matches")
+        else:
+            if result["canonical_barcode"] is None:
+                result["canonical_barcode"] = self.allocator.allocate()
+                result["allocated"] = True
+            chain_barcodes = {
+                app.get_sub_chain_name(sub_chain_id): product["item_code"]
+                for sub_chain_id, product in result["matches"].items()
+            }
+            document = app.build_canonical_product(
+                result["canonical_barcode"], result["name"], result["category"], result["sub_category"], chain_barcodes
+            )
+            if self._claimed.intersection(document["chain_items"]):
+                self._add_review(result, "matches already taken by another row")
+            else:
+                self._claimed.update(document["chain_items"])
+                self._documents.append((result, document))
+        if len(self._documents) + len(self._reviews) >= self.batch_size:
+            self.flush()
+
+    def _add_review(self, result, reason):
+        matches = "; ".join(
+            f"{app.get_sub_chain_name(sub_chain_id)}: {product['item_name']} ({product['item_code']})"
+            for sub_chain_id, product in result["matches"].items()
+        )
+        self._reviews.append({
+            "row": result["row"],
+            "name": result["name"],
+            "canonical_barcode": result["canonical_barcode"] or '',
+            "category": result["category"],
+            "sub_category": result["sub_category"],
+            "reason": reason,
+            "matches": matches
+        })
+        self._finished.append({"name": result["name"], "status": "review"})
+
+    def flush(self):
+        if self._documents:
+            # Items mapped by other processes since the matches were found
+            owners = find_item_owners(
+                app.canonical_products_collection, {key for _, document in self._documents for key in document["chain_items"]}
+            )
+            documents = []
+            for result, document in self._documents:
+                taken = sorted({owners[key] for key in document["chain_items"] if key in owners})
+                if taken:
+                    self._claimed.difference_update(document["chain_items"])
+                    self._add_review(result, f"matches already mapped to {', '.join(map(str, taken))}")
+                else:
+                    documents.append((result, document))
+            self._documents = documents
+        if self._documents:
+            failed = {}
+            try:
+                app.canonical_products_collection.bulk_write(
+                    [InsertOne(document) for _, document in self._documents], ordered=False
+                )
+            except BulkWriteError as e:
+                failed = {error["index"]: error for error in e.details.get("writeErrors", [])}
+            sheet_barcodes = []
+            for index, (result, document) in enumerate(self._documents):
+                if index in failed:
+                    reason = "canonical barcode already exists" if failed[index].get("code") == 11000 else failed[index].get("errmsg", "write failed")
+                    self._claimed.difference_update(document["chain_items"])
+                    self._add_review(result, reason)
+                else:
+                    self.saved += 1
+                    get_item_mappings(app.canonical_products_collection).add(document)
+                    self._finished.append({"name": result["name"], "status": "saved", "canonical_barcode": document["canonical_barcode"]})
+                    if not result.get("allocated"):
+                        sheet_barcodes.append(document["canonical_barcode"])
+            if sheet_barcodes:
+                # Keep the barcode counter ahead of barcodes taken from the sheet
+                self.allocator.mark_used(*sheet_barcodes)
+        if self._reviews:
+            write_header = not os.path.exists(self.review_file)
+            with open(self.review_file, 'a', newline='', encoding='utf-8') as f:
+                writer = csv.DictWriter(f, fieldnames=REVIEW_FIELDS)
+                if write_header:
+                    writer.writeheader()
+                writer.writerows(self._reviews)
+            self.review += len(self._reviews)
+        if self._finished:
+            with open(self.state_file, 'a', encoding='utf-8') as f:
+                for entry in self._finished:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._documents, self._reviews, self._finished = [], [], []
+
+
+def run(source, review_file, state_file, workers=8, batch_size=200, min_chains=1, progress_every=100):
+    df = load_sheet(source)
+    if 'Name' not in df.columns:
+        raise ValueError("The sheet must contain a 'Name' column.")
+    app.get_chain_names()
+    app.get_sub_chain_names()
+
+    finished = load_finished(state_file)
+    rows = [(row_number, row) for row_number, row in sheet_rows(df) if str(row['Name']).strip() not in finished]
+    total = len(rows)
+    print(f"{len(finished)} rows already processed, {total} to go.", file=sys.stderr)
+
+    builder = BulkBuilder(review_file, state_file, batch_size=batch_size, min_chains=min_chains)
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(lambda item: process_row(*item), rows)
+        for done, result in enumerate(results, start=1):
+            builder.handle(result)
+            if done % progress_every == 0 or done == total:
+                rate = done / max(time.monotonic() - started, 1e-9)
+                print(f"[{done}/{total}] saved={builder.saved} review={builder.review + len(builder._reviews)} ({rate:.1f} rows/s)", file=sys.stderr)
+    builder.flush()
+    return builder.saved, builder.review
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build canonical products for every row of a sheet.")
+    parser.add_argument("source", help="Google Sheets URL or path to an .xlsx/.csv file")
+    parser.add_argument("--review-file", default="review.csv", help="CSV of rows that need a human (default: review.csv)")
+    parser.add_argument("--state-file", help="progress file used to resume (default: <review-file>.state.jsonl)")
+    parser.add_argument("--workers", type=int, default=8, help="parallel search workers (default: 8)")
+    parser.add_argument("--batch-size", type=int, default=200, help="documents per bulk write (default: 200)")
+    parser.add_argument("--min-chains", type=int, default=1, help="exact matches needed to save a row without review (default: 1)")
+    args = parser.parse_args(argv)
+
+    state_file = args.state_file or f"{args.review_file}.state.jsonl"
+    saved, review = run(args.source, args.review_file, state_file, workers=args.workers,
+                        batch_size=args.batch_size, min_chains=args.min_chains)
+    print(f"Saved {saved} canonical products, {review} rows written to {args.review_file}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import re
+
+import pymongo
+from pymongo import UpdateOne
+
+# Helpers for the products collection (the PriceFull rows published by the chains)
+
+
+def extract_chain_and_sub_chain_id(file_name):
+    match = re.search(r'PriceFull(\d+)-(\d+)-', file_name)
+    if match:
+        chain_id = match.group(1)
+        sub_chain_id = match.group(2).lstrip('0') or '0'  # Remove leading zeros
+        return chain_id, sub_chain_id
+    else:
+        return None, None
+
+
+def price_file_timestamp(file_name):
+    # Publication time encoded in a PriceFull file name (PriceFull<chain>-<store>-<YYYYMMDDHHMM>),
+    # as an integer that orders files chronologically; 0 when it cannot be parsed
+    match = re.search(r'PriceFull\d+-\d+-(\d+)', file_name or '')
+    return int(match.group(1)) if match else 0
+
+
+def sub_chain_key_for(file_name):
+    chain_id, sub_chain_id = extract_chain_and_sub_chain_id(file_name or '')
+    if chain_id and sub_chain_id:
+        return f"{chain_id}-{sub_chain_id}"
+    return None
+
+
+def is_gtin(item_code):
+    # A manufacturer barcode (GTIN-8/12/13/14) that identifies the same item in
+    # every chain. Shorter codes and the 2xx in-store range are chain-internal.
+    code = str(item_code or '').strip()
+    return code.isdigit() and len(code) in (8, 12, 13, 14) and code.zfill(14)[1] != '2'
+
+
+def normalize_item_name(item_name):
+    # Key for exact matching: case, punctuation and whitespace folded
+    item_name = str(item_name or '').casefold()
+    item_name = re.sub(r'["\'״׳`]', '', item_name)  # ק"ג -> קג
+    item_name = re.sub(r'[^\w\s]|_', ' ', item_name)
+    return ' '.join(item_name.split())
+
+
+# Niqqud and cantillation marks, and final letter forms mapped to regular ones,
+# so a prefix typed mid-word ("מלפפונ") matches the stored word ("מלפפונים")
+HEBREW_MARKS = re.compile('[\u0591-\u05c7]')
+HEBREW_FINAL_LETTERS = str.maketrans('ךםןףץ', 'כמנפצ')
+
+
+def tokenize_item_name(item_name):
+    # Words of an item name, in order and without duplicates
+    item_name = HEBREW_MARKS.sub('', str(item_name or '').casefold()).translate(HEBREW_FINAL_LETTERS)
+    item_name = re.sub(r'["\'״׳`]', '', item_name)
+    item_name = re.sub(r'(?<=\d)(?=[^\W\d_])|(?<=[^\W\d_])(?=\d)', ' ', item_name)  # 500גרם -> 500 גרם
+    tokens = re.split(r'[^\w]+|_', item_name)
+    return list(dict.fromkeys(token for token in tokens if token))
+
+
+def name_suffixes(item_name):
+    # Every suffix of every word, for the name_suffixes index. Any substring of
+    # a word is a prefix of one of its suffixes, so prefix-anchored lookups also
+    # find words behind Hebrew prefix letters ("וחלב" for "חלב") and matches
+    # inside a word ("milk" for "ilk").
+    suffixes = []
+    for token in tokenize_item_name(item_name):
+        suffixes += [token[start:] for start in range(len(token))]
+    return list(dict.fromkeys(suffixes))
+
+
+def ensure_product_indexes(products_collection):
+    products_collection.create_index([("chain_id", pymongo.ASCENDING), ("sub_chain_id", pymongo.ASCENDING)])
+    products_collection.create_index([("sub_chain_key", pymongo.ASCENDING)])
+    products_collection.create_index([("file_name", pymongo.ASCENDING)])
+    products_collection.create_index([("name_key", pymongo.ASCENDING), ("sub_chain_key", pymongo.ASCENDING)])
+    products_collection.create_index([("name_suffixes", pymongo.ASCENDING)])
+    # prices.py looks up the rows of mapped items by item code
+    products_collection.create_index([("item_code", pymongo.ASCENDING), ("sub_chain_key", pymongo.ASCENDING)])
+
+
+def backfill_sub_chain_ids(products_collection):
+    # Store the chain / sub-chain parsed from file_name on every product so
+    # searches can filter sub-chains in the query instead of in Python.
+    # Only documents without sub_chain_key are touched, so this doubles as the
+    # ingest step for newly loaded PriceFull files.
+    pending = {"sub_chain_key": {"$exists": False}}
+    updated = 0
+    for file_name in products_collection.distinct("file_name", pending):
+        chain_id, sub_chain_id = extract_chain_and_sub_chain_id(file_name or '')
+        if chain_id and sub_chain_id:
+            fields = {
+                "chain_id": chain_id,
+                "sub_chain_id": sub_chain_id,
+                "sub_chain_key": f"{chain_id}-{sub_chain_id}"
+            }
+        else:
+            # Mark unparseable files so they are not revisited on every run
+            fields = {"sub_chain_key": None}
+        result = products_collection.update_many(dict(pending, file_name=file_name), {"$set": fields})
+        updated += result.modified_count
+    return updated
+
+
+def backfill_name_keys(products_collection, batch_size=1000):
+    # Store the exact-match name_key and the searchable name_suffixes on
+    # products that do not have them yet (name_tokens is the older word-only field)
+    updated = 0
+    updates = []
+    pending = {"$or": [{"name_key": {"$exists": False}}, {"name_suffixes": {"$exists": False}}]}
+    cursor = products_collection.find(pending, {"_id": 1, "item_name": 1})
+    for product in cursor:
+        fields = {
+            "name_key": normalize_item_name(product.get("item_name")),
+            "name_suffixes": name_suffixes(product.get("item_name"))
+        }
+        updates.append(UpdateOne({"_id": product["_id"]}, {"$set": fields, "$unset": {"name_tokens": ""}}))
+        if len(updates) >= batch_size:
+            updated += products_collection.bulk_write(updates, ordered=False).modified_count
+            updates = []
+    if updates:
+        updated += products_collection.bulk_write(updates, ordered=False).modified_count
+    return updated
+
+
+if __name__ == "__main__":
+    from db import get_collection
+
+    products_collection = get_collection("products")
+    ensure_product_indexes(products_collection)
+    print(f"Backfilled sub-chain fields on {backfill_sub_chain_ids(products_collection)} products.")
+    print(f"Backfilled name keys on {backfill_name_keys(products_collection)} products.")
@@ -0,0 +1,216 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import pymongo
+
+# Connection layer shared by the Streamlit app and the command-line tools.
+#
+# Streamlit re-executes app.py on every widget interaction, but imported
+# modules stay in sys.modules, so the client and caches below live for the
+# whole process. Nothing connects at import time; the client is created on the
+# first get_mongo_client() call.
+#
+# Settings are read from environment variables first and then from the [mongo]
+# section of .streamlit/secrets.toml.
+
+DEFAULT_DATABASE = "supermarkets"
+
+
+def get_setting(name, default=None):
+    value = os.environ.get(name)
+    if value is not None:
+        return value
+    try:
+        import streamlit as st
+        return st.secrets["mongo"].get(name, default)
+    except Exception:
+        return default
+
+
+def _int_setting(name, default):
+    value = get_setting(name)
+    return int(value) if value not in (None, '') else default
+
+
+def get_mongo_settings():
+    uri = get_setting("MONGO_URI")
+    if not uri:
+        username = get_setting("MONGO_USERNAME")
+        password = get_setting("MONGO_PASSWORD")
+        cluster = get_setting("MONGO_CLUSTER")
+        uri = f"mongodb+srv://{username}:{password}@{cluster}/?retryWrites=true&w=majority"
+    return {
+        "uri": uri,
+        "database": get_setting("MONGO_DATABASE", DEFAULT_DATABASE),
+        "client_options": {
+            "maxPoolSize": _int_setting("MONGO_MAX_POOL_SIZE", 50),
+            "minPoolSize": _int_setting("MONGO_MIN_POOL_SIZE", 0),
+            "maxIdleTimeMS": _int_setting("MONGO_MAX_IDLE_TIME_MS", 300000),
+            "connectTimeoutMS": _int_setting("MONGO_CONNECT_TIMEOUT_MS", 10000),
+            "serverSelectionTimeoutMS": _int_setting("MONGO_SERVER_SELECTION_TIMEOUT_MS", 10000),
+            "socketTimeoutMS": _int_setting("MONGO_SOCKET_TIMEOUT_MS", 60000),
+        },
+    }
+
+
+_client = None
+_database_name = None
+_client_lock = threading.Lock()
+_client_change_callbacks = []
+
+
+def on_client_change(callback):
+    # Call callback() whenever the client is replaced or closed, for state that
+    # belongs to one database (e.g. the barcode counters seeded so far)
+    _client_change_callbacks.append(callback)
+
+
+def _client_changed():
+    reference_cache.clear()
+    for callback in _client_change_callbacks:
+        callback()
+
+
+def get_mongo_client():
+    # One pooled client per process
+    global _client, _database_name
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                settings = get_mongo_settings()
+                _database_name = settings["database"]
+                _client = pymongo.MongoClient(settings["uri"], connect=False, **settings["client_options"])
+    return _client
+
+
+def set_mongo_client(client, database=DEFAULT_DATABASE):
+    # Use an existing client (a local mongod or a stand-in) instead of the
+    # configured one
+    global _client, _database_name
+    with _client_lock:
+        _client = client
+        _database_name = database
+    _client_changed()
+
+
+def close_mongo_client():
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = None
+    _client_changed()
+
+
+def get_database():
+    client = get_mongo_client()
+    return client[_database_name]
+
+
+def get_collection(name):
+    return get_database()[name]
+
+
+_query_executor = None
+
+
+def get_query_executor():
+    # Thread pool for running independent queries concurrently (pymongo is
+    # thread-safe and shares the client's connection pool between threads)
+    global _query_executor
+    if _query_executor is None:
+        with _client_lock:
+            if _query_executor is None:
+                _query_executor = ThreadPoolExecutor(
+                    max_workers=_int_setting("MONGO_QUERY_WORKERS", 16), thread_name_prefix="mongo-query"
+                )
+    return _query_executor
+
+
+class LazyCollection:
+    # Module-level stand-in for a collection that resolves the shared client
+    # on first use, so importing a module never opens a connection
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(get_collection(self.name), attr)
+
+    def __repr__(self):
+        return f"LazyCollection({self.name!r})"
+
+
+class TTLCache:
+    def __init__(self, ttl=600):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, key, loader, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                return entry[1]
+        # Load outside the lock so a slow query does not block other keys
+        value = loader()
+        with self._lock:
+            self._entries[key] = (now + ttl, value)
+        return value
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class LRUCache:
+    # Bounded cache that evicts the least recently used entry; entries also
+    # expire after ttl seconds when a ttl is given
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > now):
+                self._entries.move_to_end(key)
+                return entry[1]
+        value = loader()
+        expires = now + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Chains, sub-chains and categories change rarely; app.py reads them through
+# this cache and invalidates the category keys when it saves a product
+reference_cache = TTLCache(_int_setting("REFERENCE_CACHE_TTL", 600))
+
+# Rendered search results, keyed by search term, exclude words and excluded
+# sub-chains, so reruns with an unchanged search do no work
+search_results_cache = LRUCache(
+    maxsize=_int_setting("SEARCH_RESULTS_CACHE_SIZE", 128), ttl=_int_setting("SEARCH_RESULTS_CACHE_TTL", 300)
+)
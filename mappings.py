@@ -0,0 +1,116 @@
+import threading
+import time
+
+import pymongo
+from pymongo import UpdateOne
+
+# Reverse index from chain items to canonical products.
+#
+# canonical_products stores its mappings as chains: {sub_chain_name: item_code},
+# which cannot be looked up by item. Every canonical product also carries
+# chain_items, a multikey-indexed list of "<sub_chain_name>:<item_code>" keys,
+# and each process keeps those keys in a dict (key -> canonical_barcode) so
+# search and auto-suggestion can skip already-mapped items in O(1).
+
+
+def mapping_key(sub_chain_name, item_code):
+    return f"{sub_chain_name}:{item_code}"
+
+
+def chain_items(chains):
+    return [mapping_key(sub_chain_name, item_code) for sub_chain_name, item_code in (chains or {}).items()]
+
+
+def ensure_mapping_indexes(canonical_collection):
+    canonical_collection.create_index([("chain_items", pymongo.ASCENDING)])
+
+
+def backfill_chain_items(canonical_collection, batch_size=1000):
+    # Add chain_items to canonical products saved before it existed
+    updated = 0
+    updates = []
+    cursor = canonical_collection.find({"chain_items": {"$exists": False}}, {"_id": 1, "chains": 1})
+    for product in cursor:
+        updates.append(UpdateOne({"_id": product["_id"]}, {"$set": {"chain_items": chain_items(product.get("chains"))}}))
+        if len(updates) >= batch_size:
+            updated += canonical_collection.bulk_write(updates, ordered=False).modified_count
+            updates = []
+    if updates:
+        updated += canonical_collection.bulk_write(updates, ordered=False).modified_count
+    return updated
+
+
+def find_conflicts(canonical_collection, chains):
+    # Canonical products that already map any of these chain items (indexed)
+    keys = chain_items(chains)
+    if not keys:
+        return []
+    return list(canonical_collection.find({"chain_items": {"$in": keys}}, {"_id": 0, "canonical_barcode": 1, "name": 1, "chains": 1}))
+
+
+def find_item_owners(canonical_collection, keys):
+    # {chain item key: canonical_barcode} for the keys some canonical product already maps
+    keys = list(keys)
+    if not keys:
+        return {}
+    owners = {}
+    for product in canonical_collection.find({"chain_items": {"$in": keys}}, {"_id": 0, "canonical_barcode": 1, "chain_items": 1}):
+        for key in product.get("chain_items") or []:
+            owners[key] = product.get("canonical_barcode")
+    return owners
+
+
+class ItemMappings:
+    def __init__(self, canonical_collection, ttl=300):
+        self.canonical = canonical_collection
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._owners = {}
+        self._loaded_at = None
+
+    def load(self):
+        # Reads chains rather than chain_items so products that have not been
+        # backfilled are covered too
+        owners = {}
+        for product in self.canonical.find({}, {"_id": 0, "canonical_barcode": 1, "chains": 1}):
+            for key in chain_items(product.get("chains")):
+                owners[key] = product.get("canonical_barcode")
+        with self._lock:
+            self._owners = owners
+            self._loaded_at = time.monotonic()
+
+    def _ensure_loaded(self):
+        # Reload periodically to pick up products saved by other processes
+        if self._loaded_at is None or time.monotonic() - self._loaded_at >= self.ttl:
+            self.load()
+
+    def owner(self, sub_chain_name, item_code):
+        # canonical_barcode the item is mapped to, or None
+        self._ensure_loaded()
+        return self._owners.get(mapping_key(sub_chain_name, item_code))
+
+    def add(self, product):
+        with self._lock:
+            for key in chain_items(product.get("chains")):
+                self._owners[key] = product.get("canonical_barcode")
+
+
+_item_mappings = None
+_item_mappings_lock = threading.Lock()
+
+
+def get_item_mappings(canonical_collection):
+    # One reverse index per process
+    global _item_mappings
+    with _item_mappings_lock:
+        if _item_mappings is None:
+            _item_mappings = ItemMappings(canonical_collection)
+    return _item_mappings
+
+
+if __name__ == "__main__":
+    from db import get_collection
+
+    canonical_collection = get_collection("canonical_products")
+    ensure_mapping_indexes(canonical_collection)
+    print(f"Backfilled chain_items on {backfill_chain_items(canonical_collection)} canonical products.")
@@ -0,0 +1,266 @@
+import argparse
+import os
+from datetime import datetime
+
+import numpy as np
+from pymongo import ReplaceOne
+
+import app
+from catalog import price_file_timestamp, sub_chain_key_for
+from db import LazyCollection, get_setting
+from mappings import mapping_key
+
+# Cross-chain price matrix for canonical products.
+#
+# Every canonical product's chains entries are joined back to the newest
+# products row of that item in that sub-chain (newest PriceFull file by the
+# timestamp in file_name). The result is stored twice: one document per
+# canonical product in the price_matrix collection, and a canonical_barcode x
+# sub-chain float32 matrix in a NumPy .npz file for vectorized queries.
+#
+# Refreshes are incremental. The job remembers the newest products _id and
+# canonical created_at/updated_at it has seen (in the counters collection) and
+# only recomputes canonical products created or updated since then or mapping
+# an item that appeared in a newer price file.
+#
+#   python prices.py refresh
+#   python prices.py cheapest 100001 100002 100003
+
+PRICE_FIELD = "item_price"
+STATE_ID = "price_matrix"
+QUERY_CHUNK = 1000
+
+price_matrix_collection = LazyCollection("price_matrix")
+
+
+def matrix_path():
+    return get_setting("PRICE_MATRIX_PATH") or "price_matrix.npz"
+
+
+def _price(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class PriceMatrix:
+    def __init__(self, barcodes=None, sub_chains=None, prices=None):
+        self.barcodes = np.asarray(barcodes if barcodes is not None else [], dtype=np.int64)
+        self.sub_chains = np.asarray(sub_chains if sub_chains is not None else [], dtype=str)
+        if prices is None:
+            prices = np.full((len(self.barcodes), len(self.sub_chains)), np.nan, dtype=np.float32)
+        self.prices = np.asarray(prices, dtype=np.float32)
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            return cls()
+        with np.load(path) as data:
+            return cls(data["barcodes"], data["sub_chains"], data["prices"])
+
+    def save(self, path):
+        temp_path = f"{path}.tmp.npz"
+        np.savez(temp_path, barcodes=self.barcodes, sub_chains=self.sub_chains, prices=self.prices)
+        os.replace(temp_path, path)
+
+    def update(self, rows):
+        # Replace the rows of the given canonical barcodes ({barcode: {sub_chain_key: price}})
+        columns = {sub_chain: i for i, sub_chain in enumerate(self.sub_chains.tolist())}
+        new_columns = sorted({sub_chain for prices in rows.values() for sub_chain in prices} - columns.keys())
+        for sub_chain in new_columns:
+            columns[sub_chain] = len(columns)
+        positions = {barcode: i for i, barcode in enumerate(self.barcodes.tolist())}
+        new_barcodes = [barcode for barcode in rows if barcode not in positions]
+        for barcode in new_barcodes:
+            positions[barcode] = len(positions)
+        prices = np.full((len(positions), len(columns)), np.nan, dtype=np.float32)
+        prices[:self.prices.shape[0], :self.prices.shape[1]] = self.prices
+        for barcode, sub_chain_prices in rows.items():
+            row = positions[barcode]
+            prices[row] = np.nan
+            for sub_chain, price in sub_chain_prices.items():
+                prices[row, columns[sub_chain]] = price
+        barcodes = np.asarray(self.barcodes.tolist() + new_barcodes, dtype=np.int64)
+        # Keep rows sorted by barcode so lookups can use searchsorted
+        order = np.argsort(barcodes, kind='stable')
+        self.barcodes = barcodes[order]
+        self.prices = prices[order]
+        self.sub_chains = np.asarray(self.sub_chains.tolist() + new_columns, dtype=str)
+
+    def rows_for(self, barcodes):
+        # Price rows for the barcodes; unknown barcodes get all-NaN rows
+        barcodes = np.asarray(barcodes, dtype=np.int64)
+        positions = np.searchsorted(self.barcodes, barcodes)
+        positions = np.minimum(positions, max(len(self.barcodes) - 1, 0))
+        found = (self.barcodes[positions] == barcodes) if len(self.barcodes) else np.zeros(len(barcodes), dtype=bool)
+        rows = np.full((len(barcodes), len(self.sub_chains)), np.nan, dtype=np.float32)
+        if len(self.barcodes):
+            rows[found] = self.prices[positions[found]]
+        return rows
+
+    def cheapest_items(self, barcodes):
+        # Cheapest sub-chain and price for every barcode (None/NaN when no prices)
+        rows = self.rows_for(barcodes)
+        filled = np.where(np.isnan(rows), np.inf, rows)
+        if not filled.shape[1]:
+            return [(barcode, None, float('nan')) for barcode in barcodes]
+        best = filled.argmin(axis=1)
+        best_prices = filled[np.arange(len(best)), best]
+        return [
+            (barcode, self.sub_chains[column] if np.isfinite(price) else None, float(price) if np.isfinite(price) else float('nan'))
+            for barcode, column, price in zip(barcodes, best, best_prices)
+        ]
+
+    def cheapest_sub_chains(self, barcodes):
+        # Basket total per sub-chain, ordered by fewest missing items then lowest total
+        rows = self.rows_for(barcodes)
+        missing = np.isnan(rows).sum(axis=0)
+        totals = np.nansum(rows, axis=0)
+        order = np.lexsort((totals, missing))
+        return [
+            {"sub_chain_id": self.sub_chains[i], "total": float(totals[i]), "missing": int(missing[i])}
+            for i in order
+        ]
+
+
+def load_state():
+    return app.counters_collection.find_one({"_id": STATE_ID}) or {}
+
+
+def save_state(last_product_id, last_changed_at):
+    app.counters_collection.update_one(
+        {"_id": STATE_ID},
+        {"$set": {"last_product_id": last_product_id, "last_changed_at": last_changed_at}},
+        upsert=True
+    )
+
+
+def sub_chain_keys_by_name():
+    # chains maps are keyed by sub-chain name; several sub-chains can share a name
+    keys = {}
+    for sub_chain_key, sub_chain_name in app.get_sub_chain_names().items():
+        keys.setdefault(sub_chain_name, []).append(sub_chain_key)
+    return keys
+
+
+def changed_canonical_products(state):
+    # Canonical products created or updated (e.g. by rematch.py) since the last
+    # run or mapping an item that appeared in a newer price file, plus the new watermarks
+    projection = {"_id": 0, "canonical_barcode": 1, "name": 1, "chains": 1, "created_at": 1, "updated_at": 1}
+    last_changed_at = state.get("last_changed_at")
+    query = {"$or": [{"created_at": {"$gte": last_changed_at}}, {"updated_at": {"$gte": last_changed_at}}]} if last_changed_at else {}
+    changed = {product["canonical_barcode"]: product for product in app.canonical_products_collection.find(query, projection)}
+    new_last_changed_at = max(
+        [last_changed_at or ''] + [max(product.get("created_at") or '', product.get("updated_at") or '') for product in changed.values()]
+    )
+
+    last_product_id = state.get("last_product_id")
+    new_last_product_id = last_product_id
+    if last_product_id is not None:
+        sub_chain_names = app.get_sub_chain_names()
+        keys = set()
+        cursor = app.products_collection.find(
+            {"_id": {"$gt": last_product_id}}, {"_id": 1, "item_code": 1, "sub_chain_key": 1, "file_name": 1}
+        )
+        for product in cursor.sort("_id", 1):
+            new_last_product_id = product["_id"]
+            # Rows inserted after the last catalog.py backfill have no sub_chain_key yet
+            sub_chain_key = product.get("sub_chain_key") or sub_chain_key_for(product.get("file_name"))
+            sub_chain_name = sub_chain_names.get(sub_chain_key)
+            if sub_chain_name:
+                keys.add(mapping_key(sub_chain_name, product.get("item_code")))
+        keys = list(keys)
+        for start in range(0, len(keys), QUERY_CHUNK):
+            cursor = app.canonical_products_collection.find({"chain_items": {"$in": keys[start:start + QUERY_CHUNK]}}, projection)
+            for product in cursor:
+                changed[product["canonical_barcode"]] = product
+    else:
+        newest = app.products_collection.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+        new_last_product_id = newest["_id"] if newest else None
+    return list(changed.values()), new_last_product_id, new_last_changed_at
+
+
+def latest_prices(canonical_products):
+    # {canonical_barcode: {sub_chain_key: price}} from the newest products row
+    # of every mapped item
+    keys_by_name = sub_chain_keys_by_name()
+    wanted = {}
+    item_codes = {}
+    for product in canonical_products:
+        for sub_chain_name, item_code in (product.get("chains") or {}).items():
+            for sub_chain_key in keys_by_name.get(sub_chain_name, []):
+                wanted.setdefault((sub_chain_key, str(item_code)), []).append(product["canonical_barcode"])
+                item_codes[str(item_code)] = item_code
+    sub_chain_keys = list({sub_chain_key for sub_chain_key, _ in wanted})
+    codes = list(item_codes.values())
+    newest = {}
+    projection = {"_id": 0, "item_code": 1, "sub_chain_key": 1, "file_name": 1, PRICE_FIELD: 1}
+    for start in range(0, len(codes), QUERY_CHUNK):
+        # Rows not backfilled yet (sub_chain_key missing) are keyed by their file name
+        query = {
+            "item_code": {"$in": codes[start:start + QUERY_CHUNK]},
+            "sub_chain_key": {"$in": sub_chain_keys + [None]}
+        }
+        for row in app.products_collection.find(query, projection):
+            sub_chain_key = row.get("sub_chain_key") or sub_chain_key_for(row.get("file_name"))
+            pair = (sub_chain_key, str(row.get("item_code")))
+            price = _price(row.get(PRICE_FIELD))
+            if pair not in wanted or price is None:
+                continue
+            timestamp = price_file_timestamp(row.get("file_name"))
+            if pair not in newest or timestamp >= newest[pair][0]:
+                newest[pair] = (timestamp, price)
+    prices = {product["canonical_barcode"]: {} for product in canonical_products}
+    for pair, (_, price) in newest.items():
+        for barcode in wanted[pair]:
+            prices[barcode][pair[0]] = price
+    return prices
+
+
+def refresh_price_matrix(path=None, full=False):
+    path = path or matrix_path()
+    state = {} if full else load_state()
+    app.get_chain_names()
+    canonical_products, last_product_id, last_changed_at = changed_canonical_products(state)
+    prices = latest_prices(canonical_products)
+
+    updated_at = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
+    writes = [
+        ReplaceOne(
+            {"_id": product["canonical_barcode"]},
+            {"name": product.get("name"), "prices": prices[product["canonical_barcode"]], "updated_at": updated_at},
+            upsert=True
+        )
+        for product in canonical_products
+    ]
+    for start in range(0, len(writes), QUERY_CHUNK):
+        price_matrix_collection.bulk_write(writes[start:start + QUERY_CHUNK], ordered=False)
+
+    matrix = PriceMatrix() if full else PriceMatrix.load(path)
+    matrix.update(prices)
+    matrix.save(path)
+    save_state(last_product_id, last_changed_at)
+    return len(canonical_products)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain and query the cross-chain price matrix.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    refresh_parser = subparsers.add_parser("refresh", help="recompute prices changed since the last run")
+    refresh_parser.add_argument("--full", action="store_true", help="rebuild the whole matrix")
+    cheapest_parser = subparsers.add_parser("cheapest", help="cheapest sub-chains for a basket of canonical barcodes")
+    cheapest_parser.add_argument("barcodes", nargs="+", type=int)
+    args = parser.parse_args(argv)
+
+    if args.command == "refresh":
+        print(f"Updated prices of {refresh_price_matrix(full=args.full)} canonical products.")
+    else:
+        app.get_chain_names()
+        app.get_sub_chain_names()
+        for entry in PriceMatrix.load(matrix_path()).cheapest_sub_chains(args.barcodes)[:10]:
+            print(f"{app.get_sub_chain_name(entry['sub_chain_id'])}\t{entry['total']:.2f}\tmissing {entry['missing']}")
+
+
+if __name__ == "__main__":
+    main()
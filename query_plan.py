@@ -0,0 +1,121 @@
+import re
+from collections import deque
+from functools import lru_cache
+
+from catalog import tokenize_item_name
+
+# Compiles a search term and exclude words into a query plan.
+#
+# The search term becomes an index-friendly filter: one prefix-anchored regex
+# per token on the multikey name_suffixes field, which MongoDB answers from
+# index bounds. Products ingested since the last backfill have no
+# name_suffixes and are matched by the unanchored regex on item_name instead.
+# The filter only narrows the candidates: accepts() keeps the names that
+# contain the search term, the same substring match the in-memory index and
+# the snapshot use, so every backend returns the same products.
+#
+# Exclude words never go into the query (a negative lookahead makes Mongo
+# backtrack over every name); they are removed from the candidates afterwards
+# by an Aho-Corasick matcher that reads each name once, however many words are
+# excluded.
+
+
+class ExcludeMatcher:
+    def __init__(self, words):
+        # Trie of the words with failure links; state 0 is the root
+        self.transitions = [{}]
+        self.failure = [0]
+        self.terminal = [False]
+        for word in words:
+            state = 0
+            for char in word:
+                next_state = self.transitions[state].get(char)
+                if next_state is None:
+                    next_state = len(self.transitions)
+                    self.transitions[state][char] = next_state
+                    self.transitions.append({})
+                    self.failure.append(0)
+                    self.terminal.append(False)
+                state = next_state
+            self.terminal[state] = True
+        queue = deque(self.transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.transitions[state].items():
+                queue.append(next_state)
+                fallback = self.failure[state]
+                while fallback and char not in self.transitions[fallback]:
+                    fallback = self.failure[fallback]
+                candidate = self.transitions[fallback].get(char, 0)
+                self.failure[next_state] = candidate if candidate != next_state else 0
+                self.terminal[next_state] = self.terminal[next_state] or self.terminal[self.failure[next_state]]
+
+    def __bool__(self):
+        return len(self.transitions) > 1
+
+    def search(self, text):
+        # True if any of the words occurs in text
+        transitions, failure, terminal = self.transitions, self.failure, self.terminal
+        state = 0
+        for char in text:
+            while state and char not in transitions[state]:
+                state = failure[state]
+            state = transitions[state].get(char, 0)
+            if terminal[state]:
+                return True
+        return False
+
+
+@lru_cache(maxsize=256)
+def _exclude_matcher(words):
+    return ExcludeMatcher(words)
+
+
+def get_exclude_matcher(exclude_words):
+    # Matchers are cached per set of (lowercased) words
+    return _exclude_matcher(tuple(sorted({word.lower() for word in exclude_words if word})))
+
+
+class QueryPlan:
+    def __init__(self, term, filter, exclude_matcher):
+        self.term = term
+        self.filter = filter
+        self.exclude_matcher = exclude_matcher
+
+    def accepts(self, item_name):
+        item_name = str(item_name or '').lower()
+        if self.term not in item_name:
+            return False
+        return not (self.exclude_matcher and self.exclude_matcher.search(item_name))
+
+
+def match_relevance(item_name, search_term):
+    # 3 for an exact match, 2 for a prefix match, 1 for any other substring match
+    item_name = str(item_name or '').lower()
+    search_term = search_term.lower()
+    if item_name == search_term:
+        return 3
+    if item_name.startswith(search_term):
+        return 2
+    if search_term in item_name:
+        return 1
+    return 0
+
+
+def candidate_rank(item_name, search_term):
+    # Sort key for the matches kept per sub-chain before fuzzy ranking: closer
+    # matches first, then shorter names (which score higher against the term)
+    return (-match_relevance(item_name, search_term), len(str(item_name or '')))
+
+
+def compile_query(search_term, exclude_words=()):
+    tokens = tokenize_item_name(search_term)
+    substring = {"item_name": {"$regex": f".*{re.escape(search_term)}.*", "$options": "i"}}
+    if tokens:
+        filter = {"$or": [
+            {"$and": [{"name_suffixes": {"$regex": f"^{re.escape(token)}"}} for token in tokens]},
+            dict(substring, name_suffixes=None)
+        ]}
+    else:
+        filter = substring
+    return QueryPlan(search_term.lower(), filter, get_exclude_matcher(exclude_words))
@@ -0,0 +1,159 @@
+import re
+from collections import Counter
+
+import numpy as np
+from scipy import sparse
+
+# Fuzzy ranking of candidate products.
+#
+# Names are normalized (case, punctuation, unit spellings), split into
+# character n-grams per word and weighted with TF-IDF. Scores are cosine
+# similarities computed as one sparse matrix product, so a single query can be
+# ranked against a candidate set, or a whole sheet against the catalog, in one
+# pass. Manufacturer names are scored the same way and added with a small
+# weight so a brand in the query (e.g. "תנובה") lifts that manufacturer's items.
+
+NGRAM_RANGE = (2, 4)
+MANUFACTURER_WEIGHT = 0.15
+
+# Different spellings of the same unit as they appear in PriceFull item names
+UNIT_ALIASES = {
+    'גרם': 'ג', 'גר': 'ג', 'gr': 'ג', 'g': 'ג',
+    'קג': 'קג', 'קילו': 'קג', 'kg': 'קג',
+    'מל': 'מל', 'ml': 'מל',
+    'ליטר': 'ל', 'l': 'ל',
+    'יחידות': 'יח', 'יח': 'יח',
+}
+
+
+def normalize_text(text):
+    text = text.lower() if isinstance(text, str) else ''
+    text = re.sub(r'(\w)["\'״׳](\w)', r'\1\2', text)  # ק"ג -> קג, מ"ל -> מל
+    text = re.sub(r'[^\w\s.%]', ' ', text)
+    text = re.sub(r'(\d)([^\d\s.%])', r'\1 \2', text)  # 500גרם -> 500 גרם
+    text = re.sub(r'([^\d\s.])(\d)', r'\1 \2', text)
+    return ' '.join(UNIT_ALIASES.get(token, token) for token in text.split())
+
+
+def char_ngrams(text, ngram_range=NGRAM_RANGE):
+    # N-grams inside space-padded words, so word order does not matter
+    min_n, max_n = ngram_range
+    for word in normalize_text(text).split():
+        padded = f" {word} "
+        for n in range(min_n, max_n + 1):
+            for i in range(len(padded) - n + 1):
+                yield padded[i:i + n]
+
+
+class TfidfRanker:
+    def __init__(self, ngram_range=NGRAM_RANGE, manufacturer_weight=MANUFACTURER_WEIGHT):
+        self.ngram_range = ngram_range
+        self.manufacturer_weight = manufacturer_weight
+        self.vocabulary = {}
+        self.idf = None
+        self.unseen_idf = 1.0
+        self.names = None
+        self.manufacturers = None
+
+    def _count(self, texts, grow=False, unseen=None):
+        # Sparse n-gram counts. Without grow, n-grams outside the vocabulary are
+        # dropped; their squared counts are added to unseen[row] when given.
+        indptr, indices, data = [0], [], []
+        for row, text in enumerate(texts):
+            for gram, count in Counter(char_ngrams(text, self.ngram_range)).items():
+                index = self.vocabulary.get(gram)
+                if index is None:
+                    if not grow:
+                        if unseen is not None:
+                            unseen[row] += count * count
+                        continue
+                    index = self.vocabulary[gram] = len(self.vocabulary)
+                indices.append(index)
+                data.append(count)
+            indptr.append(len(indices))
+        return sparse.csr_matrix(
+            (np.asarray(data, dtype=np.float32), np.asarray(indices, dtype=np.int32), np.asarray(indptr)),
+            shape=(len(texts), len(self.vocabulary))
+        )
+
+    def _widen(self, counts):
+        # Counts taken before the vocabulary finished growing have fewer columns
+        return sparse.csr_matrix((counts.data, counts.indices, counts.indptr), shape=(counts.shape[0], len(self.vocabulary)))
+
+    def _weight(self, counts, unseen_norm=None):
+        counts = self._widen(counts)
+        weighted = counts.multiply(self.idf).tocsr()
+        squared_norms = np.asarray(weighted.multiply(weighted).sum(axis=1)).ravel()
+        if unseen_norm is not None:
+            squared_norms = squared_norms + unseen_norm
+        norms = np.sqrt(squared_norms)
+        norms[norms == 0] = 1.0
+        return sparse.diags(1.0 / norms) @ weighted
+
+    def fit(self, names, manufacturers=None):
+        names = list(names)
+        manufacturers = list(manufacturers) if manufacturers is not None else [''] * len(names)
+        self.vocabulary = {}
+        name_counts = self._count(names, grow=True)
+        manufacturer_counts = self._count(manufacturers, grow=True)
+        vocabulary_size = len(self.vocabulary)
+        name_counts = self._widen(name_counts)
+        # Smoothed IDF over names and manufacturers together
+        document_frequency = np.bincount(name_counts.indices, minlength=vocabulary_size)
+        document_frequency += np.bincount(manufacturer_counts.indices, minlength=vocabulary_size)
+        documents = len(names) + len(manufacturers)
+        self.idf = (np.log((1 + documents) / (1 + document_frequency)) + 1).astype(np.float32)
+        # IDF of an n-gram no fitted document contains
+        self.unseen_idf = float(np.log(1 + documents) + 1)
+        self.names = self._weight(name_counts).T.tocsr()
+        self.manufacturers = self._weight(manufacturer_counts).T.tocsr()
+        return self
+
+    def score_matrix(self, queries):
+        # (queries x fitted documents) sparse matrix of similarity scores.
+        # N-grams the documents do not have still count towards the query's
+        # norm, so a long query sharing a few words with a short name scores low.
+        queries = list(queries)
+        unseen = np.zeros(len(queries), dtype=np.float64)
+        counts = self._count(queries, unseen=unseen)
+        query_vectors = self._weight(counts, unseen * self.unseen_idf ** 2)
+        scores = query_vectors @ self.names
+        if self.manufacturer_weight:
+            # Manufacturer similarity is a bonus on top of the name similarity
+            scores = scores + (query_vectors @ self.manufacturers) * self.manufacturer_weight
+        return scores.tocsr()
+
+    def scores(self, query):
+        return self.score_matrix([query]).toarray().ravel()
+
+    def top_k(self, queries, k=10, chunk_size=256):
+        # Best k documents for every query as (indices, scores) pairs, best first.
+        # Queries are processed in chunks to bound the size of the score matrix.
+        queries = list(queries)
+        results = []
+        for start in range(0, len(queries), chunk_size):
+            chunk_scores = self.score_matrix(queries[start:start + chunk_size])
+            for row in range(chunk_scores.shape[0]):
+                row_start, row_end = chunk_scores.indptr[row], chunk_scores.indptr[row + 1]
+                indices = chunk_scores.indices[row_start:row_end]
+                data = chunk_scores.data[row_start:row_end]
+                if len(data) > k:
+                    best = np.argpartition(-data, k - 1)[:k]
+                    indices, data = indices[best], data[best]
+                order = np.argsort(-data, kind='stable')
+                results.append((indices[order], data[order]))
+        return results
+
+
+def rank_products(search_term, df_products, k=None, group_by='sub_chain_id'):
+    # Attach a "score" column, sort by it and keep the best k rows per sub-chain
+    if df_products.empty:
+        return df_products.assign(score=np.zeros(0, dtype=np.float32))
+    manufacturers = df_products['manufacturer_name'] if 'manufacturer_name' in df_products else None
+    ranker = TfidfRanker().fit(df_products['item_name'], manufacturers)
+    ranked = df_products.assign(score=ranker.scores(search_term).round(4))
+    sort_columns = ['score', 'relevance'] if 'relevance' in ranked else ['score']
+    ranked = ranked.sort_values(sort_columns, ascending=False, kind='stable')
+    if k is not None:
+        ranked = ranked.groupby(group_by, sort=False).head(k)
+    return ranked
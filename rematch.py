@@ -0,0 +1,242 @@
+import argparse
+import time
+from datetime import datetime
+
+import pymongo
+from pymongo import UpdateOne
+
+import app
+from catalog import is_gtin, normalize_item_name, sub_chain_key_for
+from db import LazyCollection
+from mappings import chain_items, find_conflicts, get_item_mappings, mapping_key
+from ranking import TfidfRanker
+
+# Incremental matching of new products against existing canonical products.
+#
+# New PriceFull files bring item codes for sub-chains that existing canonical
+# products have no mapping for yet. This job reads only the products inserted
+# since its last run (an _id watermark kept in the counters collection), skips
+# items that are already mapped, and matches the rest against the canonical
+# products that lack their sub-chain:
+#   - item_code: the canonical product maps the same manufacturer barcode
+#     (GTIN) elsewhere; chain-internal codes are never compared across chains
+#   - name: the normalized item name equals the canonical name (the app's
+#     exact-match auto-suggestion)
+#   - fuzzy: TF-IDF similarity to the canonical name above a threshold
+# Matches are queued in the proposed_mappings collection for review; accepting
+# one adds the item to the canonical product's chains.
+#
+#   python rematch.py run [--watch 300]
+#   python rematch.py list
+#   python rematch.py accept <proposal id> ...
+
+STATE_ID = "rematch"
+BATCH_SIZE = 1000
+FUZZY_THRESHOLD = 0.85
+FUZZY_CANDIDATES = 5
+
+PRODUCT_PROJECTION = {"_id": 1, "item_code": 1, "item_name": 1, "file_name": 1, "sub_chain_key": 1}
+CANONICAL_PROJECTION = {"_id": 0, "canonical_barcode": 1, "name": 1, "chains": 1}
+
+proposals_collection = LazyCollection("proposed_mappings")
+
+
+def ensure_proposal_indexes():
+    proposals_collection.create_index([("status", pymongo.ASCENDING), ("canonical_barcode", pymongo.ASCENDING)])
+
+
+def load_state():
+    return app.counters_collection.find_one({"_id": STATE_ID}) or {}
+
+
+def save_state(last_product_id):
+    app.counters_collection.update_one({"_id": STATE_ID}, {"$set": {"last_product_id": last_product_id}}, upsert=True)
+
+
+class CanonicalMatcher:
+    def __init__(self, canonical_products, fuzzy_threshold=FUZZY_THRESHOLD):
+        self.products = list(canonical_products)
+        self.fuzzy_threshold = fuzzy_threshold
+        self.by_name_key = {}
+        self.by_item_code = {}
+        for position, product in enumerate(self.products):
+            self.by_name_key.setdefault(normalize_item_name(product.get("name")), []).append(position)
+            for item_code in (product.get("chains") or {}).values():
+                if is_gtin(item_code):
+                    self.by_item_code.setdefault(str(item_code).strip(), set()).add(position)
+        self.ranker = None
+        if self.products and fuzzy_threshold is not None:
+            self.ranker = TfidfRanker(manufacturer_weight=0).fit([product.get("name") or '' for product in self.products])
+
+    def match(self, items):
+        # (item, canonical product, reason, score) for every canonical product
+        # an item could be added to
+        if self.ranker is not None:
+            ranked = self.ranker.top_k([item["item_name"] for item in items], k=FUZZY_CANDIDATES)
+        else:
+            ranked = [((), ())] * len(items)
+        for item, (positions, scores) in zip(items, ranked):
+            found = {}
+            if is_gtin(item["item_code"]):
+                for position in self.by_item_code.get(str(item["item_code"]).strip(), ()):
+                    found.setdefault(position, ("item_code", 1.0))
+            for position in self.by_name_key.get(normalize_item_name(item["item_name"]), ()):
+                found.setdefault(position, ("name", 1.0))
+            for position, score in zip(positions, scores):
+                if score >= self.fuzzy_threshold:
+                    found.setdefault(int(position), ("fuzzy", round(float(score), 4)))
+            for position, (reason, score) in found.items():
+                product = self.products[position]
+                # Only sub-chains the canonical product has no item for yet
+                if item["sub_chain_name"] not in (product.get("chains") or {}):
+                    yield item, product, reason, score
+
+
+def queue_proposals(matches):
+    created_at = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
+    writes = []
+    for item, product, reason, score in matches:
+        key = mapping_key(item["sub_chain_name"], item["item_code"])
+        proposal = {
+            "canonical_barcode": product["canonical_barcode"],
+            "canonical_name": product.get("name"),
+            "sub_chain_name": item["sub_chain_name"],
+            "sub_chain_key": item["sub_chain_key"],
+            "item_code": item["item_code"],
+            "item_name": item["item_name"],
+            "reason": reason,
+            "score": score,
+            "status": "pending",
+            "created_at": created_at
+        }
+        # Proposals already queued (or reviewed) are left as they are
+        writes.append(UpdateOne({"_id": f"{product['canonical_barcode']}|{key}"}, {"$setOnInsert": proposal}, upsert=True))
+    if not writes:
+        return 0
+    return proposals_collection.bulk_write(writes, ordered=False).upserted_count
+
+
+def rematch_new_products(full=False, fuzzy_threshold=FUZZY_THRESHOLD, batch_size=BATCH_SIZE):
+    # Match products inserted since the last run; returns (products read, proposals queued)
+    ensure_proposal_indexes()
+    last_product_id = None if full else load_state().get("last_product_id")
+    app.get_chain_names()
+    sub_chain_names = app.get_sub_chain_names()
+    mappings = get_item_mappings(app.canonical_products_collection)
+    mappings.load()
+    matcher = CanonicalMatcher(app.canonical_products_collection.find({}, CANONICAL_PROJECTION), fuzzy_threshold)
+
+    query = {"_id": {"$gt": last_product_id}} if last_product_id is not None else {}
+    cursor = app.products_collection.find(query, PRODUCT_PROJECTION).sort("_id", pymongo.ASCENDING)
+    read = queued = 0
+    seen = set()
+    batch = []
+    for product in cursor:
+        read += 1
+        last_product_id = product["_id"]
+        sub_chain_key = product.get("sub_chain_key") or sub_chain_key_for(product.get("file_name", ''))
+        sub_chain_name = sub_chain_names.get(sub_chain_key)
+        item_code = product.get("item_code")
+        if not sub_chain_name or item_code is None:
+            continue
+        key = mapping_key(sub_chain_name, item_code)
+        # The same item shows up again in every new price file of its sub-chain
+        if key in seen or mappings.owner(sub_chain_name, item_code) is not None:
+            continue
+        seen.add(key)
+        batch.append({
+            "item_code": item_code,
+            "item_name": product.get("item_name") or '',
+            "sub_chain_key": sub_chain_key,
+            "sub_chain_name": sub_chain_name
+        })
+        if len(batch) >= batch_size:
+            queued += queue_proposals(matcher.match(batch))
+            save_state(last_product_id)
+            batch = []
+    queued += queue_proposals(matcher.match(batch))
+    if last_product_id is not None:
+        save_state(last_product_id)
+    return read, queued
+
+
+def list_proposals(status="pending", limit=50):
+    cursor = proposals_collection.find({"status": status}).sort("canonical_barcode", pymongo.ASCENDING)
+    return list(cursor.limit(limit))
+
+
+def set_proposal_status(proposal_id, status):
+    proposals_collection.update_one({"_id": proposal_id}, {"$set": {"status": status}})
+
+
+def accept_proposal(proposal_id):
+    # Add the proposed item to the canonical product's chains. Returns False
+    # (and marks the proposal stale) when the sub-chain was mapped or the item
+    # was taken in the meantime.
+    proposal = proposals_collection.find_one({"_id": proposal_id, "status": "pending"})
+    if proposal is None:
+        return False
+    product = app.canonical_products_collection.find_one(
+        {"canonical_barcode": proposal["canonical_barcode"]}, {"_id": 1, "chains": 1}
+    )
+    chains = dict(product.get("chains") or {}) if product else None
+    addition = {proposal["sub_chain_name"]: proposal["item_code"]}
+    if product is None or proposal["sub_chain_name"] in chains or find_conflicts(app.canonical_products_collection, addition):
+        set_proposal_status(proposal_id, "stale")
+        return False
+    chains.update(addition)
+    # Only applies if chains did not change since it was read
+    result = app.canonical_products_collection.update_one(
+        {"_id": product["_id"], "chains": product.get("chains")},
+        {"$set": {
+            "chains": chains,
+            "chain_items": chain_items(chains),
+            "updated_at": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
+        }}
+    )
+    if not result.modified_count:
+        return False
+    get_item_mappings(app.canonical_products_collection).add({"canonical_barcode": proposal["canonical_barcode"], "chains": addition})
+    set_proposal_status(proposal_id, "accepted")
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Match new products against existing canonical products.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="queue proposals for products added since the last run")
+    run_parser.add_argument("--full", action="store_true", help="match every product, not only new ones")
+    run_parser.add_argument("--threshold", type=float, default=FUZZY_THRESHOLD, help=f"fuzzy match threshold (default: {FUZZY_THRESHOLD})")
+    run_parser.add_argument("--watch", type=int, metavar="SECONDS", help="keep polling for new products every SECONDS")
+    list_parser = subparsers.add_parser("list", help="show queued proposals")
+    list_parser.add_argument("--status", default="pending")
+    list_parser.add_argument("--limit", type=int, default=50)
+    accept_parser = subparsers.add_parser("accept", help="add proposed items to their canonical products")
+    accept_parser.add_argument("ids", nargs="+")
+    reject_parser = subparsers.add_parser("reject", help="dismiss proposals")
+    reject_parser.add_argument("ids", nargs="+")
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        full = args.full
+        while True:
+            read, queued = rematch_new_products(full=full, fuzzy_threshold=args.threshold)
+            print(f"Read {read} new products, queued {queued} proposals.")
+            if not args.watch:
+                break
+            full = False
+            time.sleep(args.watch)
+    elif args.command == "list":
+        for proposal in list_proposals(args.status, args.limit):
+            print(f"{proposal['_id']}\t{proposal['reason']} {proposal['score']:.2f}\t{proposal['canonical_name']}\t<- {proposal['item_name']}")
+    elif args.command == "accept":
+        for proposal_id in args.ids:
+            print(f"{proposal_id}: {'accepted' if accept_proposal(proposal_id) else 'not applied'}")
+    else:
+        for proposal_id in args.ids:
+            set_proposal_status(proposal_id, "rejected")
+        print(f"Rejected {len(args.ids)} proposals.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+import heapq
+import threading
+import time
+from array import array
+
+from catalog import normalize_item_name, sub_chain_key_for
+from db import get_setting
+from query_plan import candidate_rank, get_exclude_matcher
+
+# In-memory trigram index over products.item_name.
+#
+# search_products used to send an unanchored, case-insensitive $regex to Mongo,
+# which no index can serve. The index below keeps the searchable fields of the
+# products collection in process memory and answers substring queries from
+# trigram posting lists. Documents are kept in _id order, so the first `limit`
+# hits are the same documents Mongo's natural order would return. A hash map
+# from normalized name to documents serves exact-match lookups.
+
+NGRAM_SIZE = 3
+# New products added to the index per lock acquisition during a refresh
+REFRESH_CHUNK = 1000
+
+INDEX_PROJECTION = {
+    "_id": 1,
+    "item_code": 1,
+    "item_name": 1,
+    "manufacturer_name": 1,
+    "file_name": 1,
+    "sub_chain_key": 1
+}
+
+
+def ngrams(text, n=NGRAM_SIZE):
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def index_entry(product):
+    # What a generation stores for a product: the document, its lowercased
+    # name, trigrams and exact-match key
+    item_name = str(product.get('item_name') or '')
+    name_lower = item_name.lower()
+    product.pop('_id', None)
+    if not product.get('sub_chain_key'):
+        product['sub_chain_key'] = sub_chain_key_for(product.get('file_name', ''))
+    return product, name_lower, ngrams(name_lower), normalize_item_name(item_name)
+
+
+class _Generation:
+    # Everything one build produces; a rebuild swaps in a new generation
+    def __init__(self):
+        self.docs = []
+        self.names = []
+        self.sub_chains = []
+        self.postings = {}
+        self.name_keys = {}
+
+    def add(self, product):
+        self.append(index_entry(product))
+
+    def append(self, entry):
+        product, name_lower, grams, name_key = entry
+        doc_id = len(self.docs)
+        self.docs.append(product)
+        self.names.append(name_lower)
+        self.sub_chains.append(product['sub_chain_key'])
+        for gram in grams:
+            posting = self.postings.get(gram)
+            if posting is None:
+                posting = self.postings[gram] = array('I')
+            posting.append(doc_id)
+        self.name_keys.setdefault(name_key, []).append(doc_id)
+
+
+class SearchIndex:
+    def __init__(self, collection, refresh_interval=60, rebuild_interval=3600):
+        self.collection = collection
+        self.refresh_interval = refresh_interval
+        self.rebuild_interval = rebuild_interval
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._generation = _Generation()
+        self._last_id = None
+        self._ready = False
+        self._last_refresh = 0.0
+        self._last_build = 0.0
+
+    @property
+    def ready(self):
+        return self._ready
+
+    def __len__(self):
+        return len(self._generation.docs)
+
+    def build(self):
+        # Full build into fresh structures, swapped in at the end so searches
+        # keep running against the previous generation meanwhile.
+        with self._build_lock:
+            generation = _Generation()
+            last_id = None
+            cursor = self.collection.find({}, INDEX_PROJECTION).sort("_id", 1)
+            for product in cursor:
+                last_id = product["_id"]
+                generation.add(product)
+            with self._lock:
+                self._generation = generation
+                self._last_id = last_id
+                self._ready = True
+                self._last_build = self._last_refresh = time.monotonic()
+
+    def refresh(self):
+        # Pick up products inserted since the last build/refresh (new PriceFull
+        # files). ObjectIds grow monotonically, so an _id range query is enough.
+        # The products are read and their trigrams computed without the index
+        # lock; searches only wait while a chunk of them is appended.
+        with self._build_lock:
+            query = {"_id": {"$gt": self._last_id}} if self._last_id is not None else {}
+            new_products = list(self.collection.find(query, INDEX_PROJECTION).sort("_id", 1))
+            for start in range(0, len(new_products), REFRESH_CHUNK):
+                chunk = new_products[start:start + REFRESH_CHUNK]
+                last_id = chunk[-1]["_id"]
+                entries = [index_entry(product) for product in chunk]
+                with self._lock:
+                    for entry in entries:
+                        self._generation.append(entry)
+                    self._last_id = last_id
+            self._last_refresh = time.monotonic()
+            return len(new_products)
+
+    def start(self, target=None):
+        # Run a build (or target) on a background thread
+        thread = threading.Thread(target=self._run_quietly, args=(target or self.build,), daemon=True)
+        thread.start()
+        return thread
+
+    def _run_quietly(self, target):
+        try:
+            target()
+        except Exception:
+            # Searches keep using the Mongo path until a build succeeds, and
+            # the previous generation when a refresh fails
+            pass
+
+    def maybe_refresh(self):
+        if not self._ready or self._build_lock.locked():
+            return
+        now = time.monotonic()
+        if now - self._last_build >= self.rebuild_interval:
+            # Full rebuild also drops products removed from the collection
+            self._last_build = now
+            self.start()
+        elif now - self._last_refresh >= self.refresh_interval:
+            self._last_refresh = now
+            self.start(self.refresh)
+
+    def search(self, search_term, excluded_sub_chains=(), exclude_words=(), limit=500, per_sub_chain=None):
+        # First `limit` matches in _id order (no limit when None); with
+        # per_sub_chain, the per_sub_chain closest matches of each sub-chain
+        term = search_term.lower()
+        exclude_matcher = get_exclude_matcher(exclude_words)
+        results = []
+        by_sub_chain = {}
+        with self._lock:
+            generation = self._generation
+            names = generation.names
+            sub_chains = generation.sub_chains
+            if len(term) >= NGRAM_SIZE:
+                postings = [generation.postings.get(gram) for gram in ngrams(term)]
+                if any(posting is None for posting in postings):
+                    return []
+                # Verify candidates from the rarest trigram; the substring check
+                # makes the result exact regardless of which posting list is used
+                candidates = min(postings, key=len)
+            else:
+                candidates = range(len(names))
+            for doc_id in candidates:
+                name = names[doc_id]
+                if term not in name:
+                    continue
+                sub_chain_key = sub_chains[doc_id]
+                if sub_chain_key is None or sub_chain_key in excluded_sub_chains:
+                    continue
+                if exclude_matcher and exclude_matcher.search(name):
+                    continue
+                if per_sub_chain is not None:
+                    by_sub_chain.setdefault(sub_chain_key, []).append(doc_id)
+                    continue
+                results.append(dict(generation.docs[doc_id]))
+                if limit is not None and len(results) >= limit:
+                    break
+            if per_sub_chain is not None:
+                kept = []
+                for doc_ids in by_sub_chain.values():
+                    kept += heapq.nsmallest(per_sub_chain, doc_ids, key=lambda doc_id: candidate_rank(names[doc_id], term))
+                results = [dict(generation.docs[doc_id]) for doc_id in sorted(kept)[:limit]]
+        return results
+
+    def exact(self, name, excluded_sub_chains=()):
+        # Products whose normalized item_name equals the normalized name
+        results = []
+        with self._lock:
+            generation = self._generation
+            for doc_id in generation.name_keys.get(normalize_item_name(name), ()):
+                sub_chain_key = generation.sub_chains[doc_id]
+                if sub_chain_key is None or sub_chain_key in excluded_sub_chains:
+                    continue
+                results.append(dict(generation.docs[doc_id]))
+        return results
+
+
+_search_index = None
+_search_index_lock = threading.Lock()
+
+
+def get_search_index(collection, refresh_interval=60, rebuild_interval=3600):
+    # One index per process; the first call starts building it in the background
+    global _search_index
+    with _search_index_lock:
+        if _search_index is None:
+            _search_index = SearchIndex(collection, refresh_interval, rebuild_interval)
+            # SEARCH_INDEX = 0 keeps every search on MongoDB
+            if str(get_setting("SEARCH_INDEX", 1)).lower() not in ("0", "false"):
+                _search_index.start()
+    return _search_index
@@ -0,0 +1,171 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from io import BytesIO, StringIO
+
+import pandas as pd
+import requests
+
+from db import get_setting
+
+# Loading the product sheet (Google Sheets export, or a local .xlsx/.csv file).
+#
+# Streamlit reruns app.py on every click, and the sheet URL stays in its text
+# box, so the sheet used to be downloaded and parsed on every rerun. Here a
+# URL is revalidated at most every SHEET_CACHE_TTL seconds, sending the ETag /
+# Last-Modified of the previous download so an unchanged sheet costs a 304.
+# A download whose SHA-256 matches the previous one is not parsed again. Local
+# files are re-read only when their size or modification time changes.
+#
+# Only the columns the builder uses are read, unless the sheet has no Name
+# column: then every column is kept, so the app can tell the sheet is missing
+# it rather than empty. Workbooks are opened with openpyxl in read-only mode,
+# which streams rows from the file instead of loading every cell into memory.
+
+COLUMNS = ["Name", "Barcode", "Category"]
+MAX_SOURCES = 16
+CHUNK_SIZE = 1 << 20
+
+_sources = {}
+_sources_lock = threading.Lock()
+
+
+class Sheet:
+    def __init__(self, source, frame, digest):
+        self.source = source
+        self.frame = frame
+        self.digest = digest  # changes exactly when the sheet's content changes
+
+
+def google_sheet_export_link(google_sheets_link):
+    # Extract the file ID
+    match = re.search(r'/d/([a-zA-Z0-9-_]+)', google_sheets_link)
+    if match:
+        file_id = match.group(1)
+        return f'https://docs.google.com/spreadsheets/d/{file_id}/export?format=xlsx'
+    return None
+
+
+def is_url(source):
+    return source.startswith(("http://", "https://"))
+
+
+def is_csv(name):
+    return name.lower().split("?")[0].endswith(".csv")
+
+
+def read_xlsx(data):
+    # data is a path or a file object; only the wanted columns of every row are kept
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(data, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None) or ()
+        names = {str(name).strip(): position for position, name in enumerate(header) if name is not None}
+        positions = {name: position for name, position in names.items() if name in COLUMNS} if "Name" in names else names
+        records = []
+        for row in rows:
+            record = [row[position] if position < len(row) else None for position in positions.values()]
+            # Formatted but empty rows at the end come back as all-None rows
+            if any(value is not None for value in record):
+                records.append(record)
+    finally:
+        workbook.close()
+    return pd.DataFrame.from_records(records, columns=list(positions))
+
+
+def read_csv(data):
+    header = list(pd.read_csv(data, nrows=0).columns)
+    if hasattr(data, "seek"):
+        data.seek(0)
+    names = [str(name).strip() for name in header]
+    usecols = (lambda name: str(name).strip() in COLUMNS) if "Name" in names else None
+    # Barcodes are read as written: pandas' default NA strings would turn a
+    # placeholder such as "N/A" into a missing barcode, and the row would get
+    # an allocated one instead of going to review. Empty cells stay missing.
+    converters = {name: lambda value: value.strip() or None for name in header if str(name).strip() == "Barcode"}
+    return pd.read_csv(data, usecols=usecols, converters=converters).rename(columns=str.strip)
+
+
+def _remember(source, entry):
+    with _sources_lock:
+        _sources.pop(source, None)
+        _sources[source] = entry
+        while len(_sources) > MAX_SOURCES:
+            _sources.pop(next(iter(_sources)))
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _load_file(path):
+    stat = os.stat(path)
+    version = (stat.st_size, stat.st_mtime_ns)
+    entry = _sources.get(path)
+    if entry is not None and entry["version"] == version:
+        return entry
+    digest = _file_digest(path)
+    if entry is None or entry["digest"] != digest:
+        # Parse from the path, so openpyxl streams the workbook from disk
+        frame = read_csv(path) if is_csv(path) else read_xlsx(path)
+    else:
+        frame = entry["frame"]  # touched but unchanged
+    entry = {"version": version, "digest": digest, "frame": frame}
+    _remember(path, entry)
+    return entry
+
+
+def _load_url(url, max_age, timeout):
+    now = time.monotonic()
+    entry = _sources.get(url)
+    if entry is not None and now - entry["checked_at"] < max_age:
+        return entry
+    headers = {}
+    if entry is not None and entry["etag"]:
+        headers["If-None-Match"] = entry["etag"]
+    if entry is not None and entry["last_modified"]:
+        headers["If-Modified-Since"] = entry["last_modified"]
+    response = requests.get(url, headers=headers, timeout=timeout)
+    if response.status_code == 304 and entry is not None:
+        digest, frame = entry["digest"], entry["frame"]
+    else:
+        response.raise_for_status()
+        digest = hashlib.sha256(response.content).hexdigest()
+        if entry is not None and entry["digest"] == digest:
+            frame = entry["frame"]
+        elif is_csv(url) or "text/csv" in response.headers.get("Content-Type", ""):
+            frame = read_csv(StringIO(response.content.decode('utf-8-sig')))
+        else:
+            frame = read_xlsx(BytesIO(response.content))
+    entry = {
+        "digest": digest,
+        "frame": frame,
+        "etag": response.headers.get("ETag") or (entry["etag"] if entry else None),
+        "last_modified": response.headers.get("Last-Modified") or (entry["last_modified"] if entry else None),
+        "checked_at": now
+    }
+    _remember(url, entry)
+    return entry
+
+
+def load_sheet(source, max_age=None, timeout=60):
+    # Sheet for a Google Sheets link, another URL or a local .xlsx/.csv path.
+    # URLs are revalidated when their last check is older than max_age seconds
+    # (SHEET_CACHE_TTL by default; 0 always revalidates).
+    source = source.strip()
+    if max_age is None:
+        max_age = int(get_setting("SHEET_CACHE_TTL", 300))
+    if is_url(source):
+        entry = _load_url(google_sheet_export_link(source) or source, max_age, timeout)
+    else:
+        entry = _load_file(source)
+    # Cached frames are shared between sessions, so every caller gets a copy
+    return Sheet(source, entry["frame"].copy(), entry["digest"])
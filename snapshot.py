@@ -0,0 +1,239 @@
+import argparse
+import heapq
+import json
+import mmap
+import os
+import shutil
+import threading
+from array import array
+from datetime import datetime
+
+import numpy as np
+
+from catalog import normalize_item_name, sub_chain_key_for
+from db import get_collection, get_setting
+from query_plan import candidate_rank, get_exclude_matcher
+
+# Local columnar snapshot of the products catalog.
+#
+# The exporter writes the columns search needs (item_code, item_name,
+# manufacturer_name, sub_chain_key) to a directory. Every string column is one
+# UTF-8 blob (<column>.bin) plus an int64 offsets array (<column>.offsets.npy)
+# with rows + 1 entries, the same layout Arrow uses for string columns. Two
+# extra blobs hold the lowercased names and the normalized name keys, each
+# entry followed by a newline, so substring and exact searches are plain
+# mmap.find calls over the file.
+#
+# The reader memory-maps everything, so opening a snapshot takes milliseconds
+# and the catalog stays in the page cache instead of the Python heap. It has
+# the same search()/exact() interface as search_index.SearchIndex and is used
+# by app.py when the PRODUCTS_SNAPSHOT setting points at a snapshot directory.
+#
+#   python snapshot.py export --output products_snapshot
+
+COLUMNS = ["item_code", "item_name", "manufacturer_name", "sub_chain_key"]
+SEARCH_COLUMNS = ["search_name", "name_key"]
+EXPORT_PROJECTION = {"_id": 1, "item_code": 1, "item_name": 1, "manufacturer_name": 1, "file_name": 1, "sub_chain_key": 1}
+SNAPSHOT_VERSION = 1
+
+
+def _text(value):
+    return '' if value is None else str(value)
+
+
+def export_snapshot(products_collection, output_dir):
+    # Write into a temporary directory and swap it in at the end, so readers
+    # never see a half-written snapshot
+    temp_dir = f"{output_dir}.tmp"
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+    files = {column: open(os.path.join(temp_dir, f"{column}.bin"), 'wb') for column in COLUMNS + SEARCH_COLUMNS}
+    offsets = {column: array('q', [0]) for column in COLUMNS + SEARCH_COLUMNS}
+    rows = 0
+    try:
+        # Separated blobs start with a newline so "\n<name key>\n" finds exact matches
+        for column in SEARCH_COLUMNS:
+            files[column].write(b"\n")
+            offsets[column][0] = 1
+        cursor = products_collection.find({}, EXPORT_PROJECTION).sort("_id", 1)
+        for product in cursor:
+            item_name = _text(product.get('item_name'))
+            values = {
+                "item_code": _text(product.get('item_code')),
+                "item_name": item_name,
+                "manufacturer_name": _text(product.get('manufacturer_name')),
+                "sub_chain_key": product.get('sub_chain_key') or sub_chain_key_for(product.get('file_name', '')) or '',
+                "search_name": item_name.lower().replace("\n", " ") + "\n",
+                "name_key": normalize_item_name(item_name) + "\n"
+            }
+            for column, value in values.items():
+                encoded = value.encode('utf-8')
+                files[column].write(encoded)
+                offsets[column].append(offsets[column][-1] + len(encoded))
+            rows += 1
+    finally:
+        for f in files.values():
+            f.close()
+    for column, column_offsets in offsets.items():
+        np.save(os.path.join(temp_dir, f"{column}.offsets.npy"), np.frombuffer(column_offsets, dtype=np.int64))
+    with open(os.path.join(temp_dir, "meta.json"), 'w', encoding='utf-8') as f:
+        json.dump({"version": SNAPSHOT_VERSION, "rows": rows, "columns": COLUMNS, "created_at": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")}, f)
+    if os.path.exists(output_dir):
+        old_dir = f"{output_dir}.old"
+        shutil.rmtree(old_dir, ignore_errors=True)
+        os.replace(output_dir, old_dir)
+        os.replace(temp_dir, output_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+    else:
+        os.replace(temp_dir, output_dir)
+    return rows
+
+
+class _StringColumn:
+    def __init__(self, path, column):
+        self.offsets = np.load(os.path.join(path, f"{column}.offsets.npy"), mmap_mode='r')
+        self._file = open(os.path.join(path, f"{column}.bin"), 'rb')
+        # mmap cannot map an empty file
+        self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(self._file.fileno()).st_size else b''
+
+    def __getitem__(self, row):
+        return self.data[int(self.offsets[row]):int(self.offsets[row + 1])].decode('utf-8')
+
+    def row_at(self, position):
+        return int(np.searchsorted(self.offsets, position, side='right')) - 1
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self._file.close()
+
+
+class ProductSnapshot:
+    ready = True
+
+    def __init__(self, path):
+        self.path = path
+        self.version = _meta_version(path)
+        with open(os.path.join(path, "meta.json"), encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.columns = {column: _StringColumn(path, column) for column in COLUMNS + SEARCH_COLUMNS}
+
+    def __len__(self):
+        return self.meta["rows"]
+
+    def maybe_refresh(self):
+        # A snapshot is refreshed by exporting it again
+        pass
+
+    def row(self, row):
+        return {column: self.columns[column][row] for column in COLUMNS}
+
+    def _find_rows(self, column, needle):
+        # Rows whose entry in a newline-separated blob contains needle, in order
+        blob = self.columns[column]
+        position = blob.data.find(needle)
+        while position != -1:
+            row = blob.row_at(position)
+            yield row
+            position = blob.data.find(needle, int(blob.offsets[row + 1]))
+
+    def search(self, search_term, excluded_sub_chains=(), exclude_words=(), limit=500, per_sub_chain=None):
+        term = search_term.lower().replace("\n", " ").encode('utf-8')
+        exclude_matcher = get_exclude_matcher(exclude_words)
+        sub_chains = self.columns["sub_chain_key"]
+        names = self.columns["search_name"]
+        results = []
+        by_sub_chain = {}
+        for row in self._find_rows("search_name", term):
+            sub_chain_key = sub_chains[row]
+            if not sub_chain_key or sub_chain_key in excluded_sub_chains:
+                continue
+            if exclude_matcher and exclude_matcher.search(names[row]):
+                continue
+            if per_sub_chain is not None:
+                by_sub_chain.setdefault(sub_chain_key, []).append(row)
+                continue
+            results.append(self.row(row))
+            if limit is not None and len(results) >= limit:
+                break
+        if per_sub_chain is not None:
+            # The closest matches of every sub-chain, not the first ones
+            search_term = search_term.lower().replace("\n", " ")
+            kept = []
+            for rows in by_sub_chain.values():
+                kept += heapq.nsmallest(per_sub_chain, rows, key=lambda row: candidate_rank(names[row][:-1], search_term))
+            results = [self.row(row) for row in sorted(kept)[:limit]]
+        return results
+
+    def exact(self, name, excluded_sub_chains=()):
+        needle = f"\n{normalize_item_name(name)}\n".encode('utf-8')
+        name_keys = self.columns["name_key"]
+        sub_chains = self.columns["sub_chain_key"]
+        results = []
+        # Entries are "<key>\n" after a leading "\n", so a match starts one byte
+        # before the row it belongs to
+        position = name_keys.data.find(needle)
+        while position != -1:
+            row = name_keys.row_at(position + 1)
+            sub_chain_key = sub_chains[row]
+            if sub_chain_key and sub_chain_key not in excluded_sub_chains:
+                results.append(self.row(row))
+            position = name_keys.data.find(needle, position + 1)
+        return results
+
+    def close(self):
+        for column in self.columns.values():
+            column.close()
+
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+
+def _meta_version(path):
+    # Every export swaps in a new directory, so meta.json's inode and mtime change
+    try:
+        stat = os.stat(os.path.join(path, "meta.json"))
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns)
+
+
+def get_snapshot():
+    # The snapshot named by PRODUCTS_SNAPSHOT, reopened when it is exported
+    # again, or None. A replaced snapshot is not closed: searches still running
+    # on it keep its maps alive until they finish.
+    global _snapshot
+    path = get_setting("PRODUCTS_SNAPSHOT")
+    if not path:
+        return None
+    version = _meta_version(path)
+    with _snapshot_lock:
+        if version is None:
+            # Missing, or an export is swapping the directory right now
+            return _snapshot if _snapshot is not None and _snapshot.path == path else None
+        if _snapshot is None or _snapshot.path != path or _snapshot.version != version:
+            _snapshot = ProductSnapshot(path)
+        return _snapshot
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export or inspect a local snapshot of the products catalog.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="dump the products collection to a snapshot directory")
+    export_parser.add_argument("--output", default=get_setting("PRODUCTS_SNAPSHOT") or "products_snapshot")
+    search_parser = subparsers.add_parser("search", help="search an existing snapshot")
+    search_parser.add_argument("term")
+    search_parser.add_argument("--path", default=get_setting("PRODUCTS_SNAPSHOT") or "products_snapshot")
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        rows = export_snapshot(get_collection("products"), args.output)
+        print(f"Exported {rows} products to {args.output}.")
+    else:
+        for product in ProductSnapshot(args.path).search(args.term, limit=20):
+            print(f"{product['item_code']}\t{product['sub_chain_key']}\t{product['item_name']}")
+
+
+if __name__ == "__main__":
+    main()
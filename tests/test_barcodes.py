@@ -0,0 +1,83 @@
+import pytest
+
+import barcodes
+from barcodes import FIRST_CANONICAL_BARCODE, BarcodeAllocator
+
+mongomock = pytest.importorskip("mongomock")
+
+
+@pytest.fixture
+def database():
+    barcodes.forget_seeded_counters()
+    yield mongomock.MongoClient().db
+    barcodes.forget_seeded_counters()
+
+
+def allocator(database, block_size=5):
+    return BarcodeAllocator(database.counters, database.canonical_products, block_size=block_size)
+
+
+def test_first_barcode_on_an_empty_collection(database):
+    assert allocator(database).allocate() == FIRST_CANONICAL_BARCODE
+
+
+def test_counter_is_seeded_from_the_highest_barcode(database):
+    database.canonical_products.insert_many([{"canonical_barcode": 100200}, {"canonical_barcode": 100500}])
+    assert allocator(database).allocate() == 100501
+
+
+def test_allocators_get_disjoint_blocks(database):
+    first, second = allocator(database), allocator(database)
+    taken = [first.allocate() for _ in range(7)] + [second.allocate() for _ in range(7)]
+    assert len(set(taken)) == len(taken)
+
+
+def test_peek_does_not_consume(database):
+    barcode_allocator = allocator(database)
+    assert barcode_allocator.peek() == barcode_allocator.peek() == barcode_allocator.allocate()
+
+
+def test_barcodes_saved_out_of_order_are_skipped(database):
+    barcode_allocator = allocator(database)
+    first = barcode_allocator.peek()
+    barcode_allocator.mark_used(first + 2)
+    barcode_allocator.mark_used(first + 3)
+    taken = [barcode_allocator.allocate() for _ in range(4)]
+    assert first + 2 not in taken and first + 3 not in taken
+    assert taken[:2] == [first, first + 1]
+
+
+def test_mark_used_consumes_the_next_barcode(database):
+    barcode_allocator = allocator(database)
+    first = barcode_allocator.peek()
+    barcode_allocator.mark_used(first)
+    assert barcode_allocator.peek() == first + 1
+
+
+def test_barcodes_outside_the_block_push_the_counter(database):
+    barcode_allocator = allocator(database)
+    first = barcode_allocator.peek()
+    barcode_allocator.mark_used(first + 1, first + 500, first + 100)
+    assert database.counters.find_one({"_id": barcodes.COUNTER_ID})["next"] == first + 501
+    assert allocator(database).allocate() == first + 501
+
+
+def test_dropped_counter_is_seeded_again(database):
+    allocator(database).allocate()
+    database.canonical_products.insert_one({"canonical_barcode": 100900})
+    database.counters.drop()
+    assert allocator(database).allocate() == 100901
+
+
+def test_switching_databases_seeds_the_new_counter(database):
+    import db
+
+    allocator(database).allocate()
+    other = mongomock.MongoClient()
+    other.other.canonical_products.insert_one({"canonical_barcode": 100500})
+    db.set_mongo_client(other, "other")
+    try:
+        assert not barcodes._seeded
+        assert allocator(other.other).allocate() == 100501
+    finally:
+        db.close_mongo_client()
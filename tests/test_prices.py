@@ -0,0 +1,54 @@
+import numpy as np
+
+from prices import PriceMatrix
+
+
+def test_update_adds_rows_and_columns_in_barcode_order():
+    matrix = PriceMatrix()
+    matrix.update({100003: {"1-1": 5.0}, 100001: {"1-2": 3.0}})
+    matrix.update({100002: {"1-1": 4.0, "2-1": 6.0}})
+    assert matrix.barcodes.tolist() == [100001, 100002, 100003]
+    assert matrix.sub_chains.tolist() == ["1-1", "1-2", "2-1"]
+    rows = matrix.rows_for([100001, 100002, 100003])
+    assert np.array_equal(rows, np.array([
+        [np.nan, 3.0, np.nan],
+        [4.0, np.nan, 6.0],
+        [5.0, np.nan, np.nan],
+    ], dtype=np.float32), equal_nan=True)
+
+
+def test_update_replaces_a_whole_row():
+    matrix = PriceMatrix()
+    matrix.update({100001: {"1-1": 5.0, "1-2": 3.0}})
+    matrix.update({100001: {"1-2": 2.5}})
+    assert np.array_equal(matrix.rows_for([100001]), np.array([[np.nan, 2.5]], dtype=np.float32), equal_nan=True)
+
+
+def test_rows_for_unknown_barcodes():
+    assert PriceMatrix().rows_for([100001]).shape == (1, 0)
+    matrix = PriceMatrix()
+    matrix.update({100002: {"1-1": 1.0}})
+    rows = matrix.rows_for([100001, 100002, 100009])
+    assert np.isnan(rows[0]).all() and np.isnan(rows[2]).all()
+    assert rows[1, 0] == 1.0
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "matrix.npz")
+    matrix = PriceMatrix()
+    matrix.update({100001: {"1-1": 5.0}})
+    matrix.save(path)
+    loaded = PriceMatrix.load(path)
+    assert loaded.barcodes.tolist() == [100001]
+    assert loaded.sub_chains.tolist() == ["1-1"]
+    assert loaded.rows_for([100001])[0, 0] == 5.0
+    assert len(PriceMatrix.load(str(tmp_path / "missing.npz")).barcodes) == 0
+
+
+def test_cheapest_items_and_sub_chains():
+    matrix = PriceMatrix()
+    matrix.update({100001: {"1-1": 5.0, "1-2": 3.0}, 100002: {"1-1": 4.0}})
+    assert matrix.cheapest_items([100001, 100002]) == [(100001, "1-2", 3.0), (100002, "1-1", 4.0)]
+    best = matrix.cheapest_sub_chains([100001, 100002])
+    assert best[0] == {"sub_chain_id": "1-1", "total": 9.0, "missing": 0}
+    assert best[1]["missing"] == 1
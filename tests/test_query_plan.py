@@ -0,0 +1,67 @@
+import random
+
+import pytest
+
+from catalog import name_suffixes
+from query_plan import ExcludeMatcher, compile_query, get_exclude_matcher, match_relevance
+
+
+def naive_search(words, text):
+    return any(word in text for word in words)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_exclude_matcher_agrees_with_substring_search(seed):
+    # A small alphabet makes overlapping words and failure-link fallbacks common
+    rnd = random.Random(seed)
+    alphabet = "abח"
+    words = {"".join(rnd.choice(alphabet) for _ in range(rnd.randint(1, 4))) for _ in range(rnd.randint(1, 6))}
+    matcher = ExcludeMatcher(words)
+    for _ in range(200):
+        text = "".join(rnd.choice(alphabet + " ") for _ in range(rnd.randint(0, 12)))
+        assert matcher.search(text) == naive_search(words, text), (words, text)
+
+
+@pytest.mark.parametrize("words, text, expected", [
+    (["he", "she", "his", "hers"], "ushers", True),
+    (["abcd", "bc"], "abce", True),
+    (["abcd", "cde"], "abcde", True),
+    (["aab"], "aaab", True),
+    (["aab"], "abab", False),
+    (["דיאט", "זירו"], "קולה זירו", True),
+    (["דיאט", "זירו"], "קולה", False),
+])
+def test_exclude_matcher_cases(words, text, expected):
+    assert ExcludeMatcher(words).search(text) is expected
+
+
+def test_empty_exclude_matcher_matches_nothing():
+    matcher = get_exclude_matcher(["", None and "x"])
+    assert not matcher
+    assert not matcher.search("anything")
+
+
+def test_exclude_words_are_lowercased():
+    assert get_exclude_matcher(["Zero"]).search("cola zero")
+
+
+def test_match_relevance():
+    assert match_relevance("Milk", "milk") == 3
+    assert match_relevance("Milk 3%", "milk") == 2
+    assert match_relevance("Chocolate milk", "milk") == 1
+    assert match_relevance("Bread", "milk") == 0
+
+
+def test_plan_accepts_only_substring_matches():
+    plan = compile_query("ilk", ["choc"])
+    assert plan.accepts("Milk 3%")
+    assert not plan.accepts("Chocolate milk")
+    assert not plan.accepts("Bread")
+
+
+def test_suffixes_cover_every_substring_of_a_word():
+    # A substring of a word is a prefix of one of the stored suffixes, so the
+    # prefix lookup finds "חלב" behind the prefix letter in "וחלב"
+    suffixes = name_suffixes("שוקו וחלב")
+    for term in ["חלב", "לב", "וחל", "קו"]:
+        assert any(suffix.startswith(term) for suffix in suffixes), term
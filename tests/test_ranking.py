@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ranking import TfidfRanker, rank_products
+
+NAMES = ["במבה", "במבה נוגט", "ביסלי גריל", "חלב 3%", "שוקו וחלב"]
+
+
+@pytest.fixture
+def ranker():
+    return TfidfRanker(manufacturer_weight=0).fit(NAMES)
+
+
+def test_exact_name_scores_one(ranker):
+    scores = ranker.scores("במבה")
+    assert scores[0] == pytest.approx(1.0, abs=1e-4)
+    assert scores.argmax() == 0
+
+
+def test_unseen_ngrams_lower_the_score(ranker):
+    # Only "במבה" is in the vocabulary; the rest of the query still counts
+    # towards its norm, so the short name is not a near-perfect match
+    long_query = "במבה נוגט שוקולד מרירה ענקית 200 גרם"
+    assert ranker.scores(long_query)[0] < 0.5
+    assert ranker.scores(long_query)[1] > ranker.scores(long_query)[0]
+
+
+def test_query_without_known_ngrams_scores_zero(ranker):
+    assert not ranker.scores("zzzz").any()
+
+
+def test_scores_stay_in_range(ranker):
+    for query in NAMES + ["חלב", "במבה נוגט גדול", ""]:
+        scores = ranker.scores(query)
+        assert np.all(scores >= 0) and np.all(scores <= 1 + 1e-5)
+
+
+def test_top_k_matches_scores(ranker):
+    queries = ["במבה", "חלב", "ביסלי"]
+    for query, (indices, scores) in zip(queries, ranker.top_k(queries, k=2, chunk_size=2)):
+        expected = np.sort(ranker.scores(query))[::-1][:len(scores)]
+        assert np.allclose(scores, expected, atol=1e-5)
+        assert np.allclose(ranker.scores(query)[indices], scores, atol=1e-5)
+
+
+def test_rank_products_keeps_best_per_group():
+    frame = pd.DataFrame({
+        "item_name": ["במבה", "במבה נוגט", "במבה", "ביסלי"],
+        "manufacturer_name": ["", "", "", ""],
+        "sub_chain_id": ["a", "a", "b", "b"],
+    })
+    ranked = rank_products("במבה", frame, k=1)
+    assert sorted(ranked["sub_chain_id"]) == ["a", "b"]
+    assert (ranked["item_name"] == "במבה").all()
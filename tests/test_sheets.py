@@ -0,0 +1,153 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import openpyxl
+import pytest
+
+import sheets
+
+
+@pytest.fixture(autouse=True)
+def clear_sources():
+    sheets._sources.clear()
+    yield
+    sheets._sources.clear()
+
+
+@pytest.fixture
+def server():
+    # Serves state["body"] as CSV, answering 304 when If-None-Match matches state["etag"]
+    state = {"body": b"Name,Barcode\nMilk,100001\n", "etag": '"v1"', "requests": []}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            state["requests"].append(dict(self.headers))
+            if state["etag"] and self.headers.get("If-None-Match") == state["etag"]:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/csv")
+            if state["etag"]:
+                self.send_header("ETag", state["etag"])
+            self.send_header("Content-Length", str(len(state["body"])))
+            self.end_headers()
+            self.wfile.write(state["body"])
+
+        def log_message(self, *args):
+            pass
+
+    httpd = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    state["url"] = f"http://127.0.0.1:{httpd.server_port}/sheet.csv"
+    yield state
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def write_xlsx(path, rows):
+    workbook = openpyxl.Workbook()
+    for row in rows:
+        workbook.active.append(row)
+    workbook.save(path)
+
+
+def test_csv_keeps_only_builder_columns(tmp_path):
+    path = tmp_path / "sheet.csv"
+    path.write_text(" Name ,Notes,Barcode\nMilk,x,100001\n", encoding="utf-8")
+    frame = sheets.load_sheet(str(path)).frame
+    assert list(frame.columns) == ["Name", "Barcode"]
+    assert frame["Name"].tolist() == ["Milk"]
+
+
+def test_xlsx_keeps_only_builder_columns_and_skips_empty_rows(tmp_path):
+    path = tmp_path / "sheet.xlsx"
+    write_xlsx(path, [["Notes", "Name", "Category"], ["x", "Milk", "Dairy"], [None, None, None]])
+    frame = sheets.load_sheet(str(path)).frame
+    assert list(frame.columns) == ["Name", "Category"]
+    assert frame.values.tolist() == [["Milk", "Dairy"]]
+
+
+@pytest.mark.parametrize("suffix", [".csv", ".xlsx"])
+def test_sheet_without_name_column_is_not_empty(tmp_path, suffix):
+    path = tmp_path / f"sheet{suffix}"
+    if suffix == ".csv":
+        path.write_text("Product,Barcode2\nMilk,100001\n", encoding="utf-8")
+    else:
+        write_xlsx(path, [["Product", "Barcode2"], ["Milk", 100001]])
+    frame = sheets.load_sheet(str(path)).frame
+    assert not frame.empty
+    assert "Name" not in frame.columns
+
+
+def test_csv_barcode_placeholders_are_kept(tmp_path):
+    path = tmp_path / "sheet.csv"
+    path.write_text("Name,Barcode\nMilk,N/A\nBread,\nCola,100001\n", encoding="utf-8")
+    barcodes = sheets.load_sheet(str(path)).frame["Barcode"].tolist()
+    assert barcodes[0] == "N/A"
+    assert barcodes[1] is None or barcodes[1] != barcodes[1]
+    assert int(barcodes[2]) == 100001
+
+
+def test_unchanged_file_is_not_parsed_again(tmp_path, monkeypatch):
+    path = tmp_path / "sheet.csv"
+    path.write_text("Name\nMilk\n", encoding="utf-8")
+    first = sheets.load_sheet(str(path))
+    monkeypatch.setattr(sheets, "read_csv", lambda data: pytest.fail("parsed again"))
+    assert sheets.load_sheet(str(path)).digest == first.digest
+    # Touched but unchanged: hashed again, not parsed
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert sheets.load_sheet(str(path)).frame["Name"].tolist() == ["Milk"]
+
+
+def test_changed_file_is_parsed_again(tmp_path):
+    path = tmp_path / "sheet.csv"
+    path.write_text("Name\nMilk\n", encoding="utf-8")
+    first = sheets.load_sheet(str(path))
+    path.write_text("Name\nMilk\nBread\n", encoding="utf-8")
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    second = sheets.load_sheet(str(path))
+    assert second.digest != first.digest
+    assert second.frame["Name"].tolist() == ["Milk", "Bread"]
+
+
+def test_url_is_revalidated_with_etag(server):
+    first = sheets.load_sheet(server["url"], max_age=0)
+    second = sheets.load_sheet(server["url"], max_age=0)
+    assert [request.get("If-None-Match") for request in server["requests"]] == [None, '"v1"']
+    assert second.digest == first.digest
+    assert second.frame["Name"].tolist() == ["Milk"]
+
+
+def test_url_is_not_requested_within_max_age(server):
+    sheets.load_sheet(server["url"], max_age=0)
+    sheets.load_sheet(server["url"], max_age=300)
+    assert len(server["requests"]) == 1
+
+
+def test_same_download_reuses_parsed_frame(server, monkeypatch):
+    server["etag"] = None
+    sheets.load_sheet(server["url"], max_age=0)
+    monkeypatch.setattr(sheets, "read_csv", lambda data: pytest.fail("parsed again"))
+    assert sheets.load_sheet(server["url"], max_age=0).frame["Name"].tolist() == ["Milk"]
+    assert len(server["requests"]) == 2
+
+
+def test_changed_download_is_parsed(server):
+    first = sheets.load_sheet(server["url"], max_age=0)
+    server["body"], server["etag"] = b"Name\nBread\n", '"v2"'
+    second = sheets.load_sheet(server["url"], max_age=0)
+    assert second.digest != first.digest
+    assert second.frame["Name"].tolist() == ["Bread"]
+
+
+def test_loaded_frames_are_copies(tmp_path):
+    path = tmp_path / "sheet.csv"
+    path.write_text("Name\nMilk\n", encoding="utf-8")
+    frame = sheets.load_sheet(str(path)).frame
+    frame.loc[0, "Name"] = "Changed"
+    assert sheets.load_sheet(str(path)).frame["Name"].tolist() == ["Milk"]
@@ -0,0 +1,108 @@
+import os
+
+import pytest
+
+import snapshot
+from catalog import normalize_item_name
+
+mongomock = pytest.importorskip("mongomock")
+
+FILE_NAME = "PriceFull7290000000001-{:03d}-202410170000.gz"
+NAMES = [
+    "חלב 3%", "Milk", "", "שוקו וחלב", "חלב", "לחם אחיד", "MILK 1L", "חלב", "line\nbreak", "ק\"ג עגבניות",
+    "é accent", "milk", "חלב טרי", "x", "חלב",
+]
+
+
+@pytest.fixture
+def products():
+    collection = mongomock.MongoClient().db.products
+    collection.insert_many([
+        {
+            "item_code": str(1000 + i),
+            "item_name": name,
+            "manufacturer_name": f"M{i % 3}",
+            "file_name": FILE_NAME.format(1 + i % 3),
+            **({"sub_chain_key": f"7290000000001-{1 + i % 3}"} if i % 2 else {})
+        }
+        for i, name in enumerate(NAMES)
+    ])
+    return collection
+
+
+@pytest.fixture
+def snap(products, tmp_path):
+    path = str(tmp_path / "snapshot")
+    snapshot.export_snapshot(products, path)
+    opened = snapshot.ProductSnapshot(path)
+    yield opened
+    opened.close()
+
+
+def item_codes(rows):
+    return sorted(row["item_code"] for row in rows)
+
+
+def test_rows_round_trip(snap):
+    assert len(snap) == len(NAMES)
+    for i, name in enumerate(NAMES):
+        row = snap.row(i)
+        assert row["item_code"] == str(1000 + i)
+        assert row["item_name"] == name
+        assert row["sub_chain_key"] == f"7290000000001-{1 + i % 3}"
+
+
+def test_row_at_maps_every_byte_to_its_row(snap):
+    column = snap.columns["search_name"]
+    for row in range(len(NAMES)):
+        for position in range(int(column.offsets[row]), int(column.offsets[row + 1])):
+            assert column.row_at(position) == row
+
+
+@pytest.mark.parametrize("term", ["חלב", "milk", "MILK", "ilk", "ב ט", "x", "line break", "ק\"ג", "é", "nothing"])
+def test_search_matches_substrings(snap, term):
+    expected = [str(1000 + i) for i, name in enumerate(NAMES) if term.lower() in name.lower().replace("\n", " ")]
+    assert item_codes(snap.search(term, limit=None)) == sorted(expected)
+
+
+def test_search_filters_sub_chains_exclude_words_and_limit(snap):
+    excluded = {"7290000000001-1"}
+    found = snap.search("חלב", excluded, ["טרי"], limit=None)
+    assert found
+    assert all(row["sub_chain_key"] not in excluded and "טרי" not in row["item_name"] for row in found)
+    assert len(snap.search("חלב", limit=2)) == 2
+
+
+def test_search_keeps_closest_matches_per_sub_chain(snap):
+    found = snap.search("חלב", per_sub_chain=1, limit=None)
+    by_sub_chain = {row["sub_chain_key"]: row["item_name"] for row in found}
+    assert len(found) == len(by_sub_chain)
+    # Every sub-chain holding an exact "חלב" keeps it over the longer names
+    for i, name in enumerate(NAMES):
+        if name == "חלב":
+            assert by_sub_chain[f"7290000000001-{1 + i % 3}"] == "חלב"
+
+
+@pytest.mark.parametrize("name", ["חלב", "milk", "MILK  1l", "ק\"ג עגבניות", "", "line break", "nothing"])
+def test_exact_matches_normalized_names(snap, name):
+    key = normalize_item_name(name)
+    expected = [str(1000 + i) for i, item_name in enumerate(NAMES) if normalize_item_name(item_name) == key]
+    assert item_codes(snap.exact(name)) == sorted(expected)
+
+
+def test_get_snapshot_reopens_a_new_export(products, tmp_path, monkeypatch):
+    path = str(tmp_path / "snapshot")
+    monkeypatch.setenv("PRODUCTS_SNAPSHOT", path)
+    monkeypatch.setattr(snapshot, "_snapshot", None)
+    assert snapshot.get_snapshot() is None
+    snapshot.export_snapshot(products, path)
+    first = snapshot.get_snapshot()
+    assert snapshot.get_snapshot() is first
+    products.insert_one({"item_code": "9999", "item_name": "חדש", "file_name": FILE_NAME.format(1)})
+    snapshot.export_snapshot(products, path)
+    second = snapshot.get_snapshot()
+    assert second is not first
+    assert len(second) == len(NAMES) + 1
+    # The replaced snapshot stays readable for searches still running on it
+    assert first.search("חלב", limit=None)
+    assert not os.path.exists(f"{path}.tmp")
@@ -0,0 +1,335 @@
+import contextvars
+import json
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from itertools import count
+
+from db import get_setting
+
+# Per-rerun timing of the app's Mongo calls and UI sections.
+#
+# Off unless TRACE_LOG (a JSON-lines file) or TRACE_PANEL = 1 (a "Performance"
+# expander in the sidebar) is set. When off, traced() hands back the collection
+# itself and section()/span()/rerun() do nothing, so the app pays one
+# ContextVar lookup per section.
+#
+# When on, every rerun collects:
+#   - sections: the numbered UI sections of main(), each timed until the next
+#     one starts, plus named spans such as the ranking step
+#   - mongo: one event per collection call with the command, the shape of the
+#     filter (values replaced by "?"), the documents returned and the time
+#     spent in the driver. Cursors are timed while they are being iterated.
+# With TRACE_EXPLAIN = 1, the first find of every filter shape is explained and
+# flagged when the winning plan is a collection scan. Calls slower than
+# TRACE_SLOW_MS (default 100) are marked slow.
+
+TIMED_METHODS = {
+    "find_one", "distinct", "count_documents", "insert_one", "insert_many", "update_one", "update_many",
+    "find_one_and_update", "bulk_write", "create_index"
+}
+FILTER_METHODS = {"find_one", "count_documents", "update_one", "update_many", "find_one_and_update"}
+
+
+def _flag(name):
+    return str(get_setting(name, 0)).lower() not in ("0", "false", "")
+
+
+LOG_PATH = get_setting("TRACE_LOG")
+PANEL = _flag("TRACE_PANEL")
+EXPLAIN = _flag("TRACE_EXPLAIN")
+SLOW_MS = float(get_setting("TRACE_SLOW_MS", 100))
+ENABLED = bool(LOG_PATH) or PANEL
+
+_current = contextvars.ContextVar("trace", default=None)
+_rerun_ids = count(1)
+_log_lock = threading.Lock()
+_explained = {}
+_explained_lock = threading.Lock()
+
+
+def filter_shape(value):
+    # The filter with its values replaced by "?", so equal query shapes group together
+    if isinstance(value, dict):
+        return {key: filter_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        shapes = [filter_shape(item) for item in value]
+        return shapes if any(shape != "?" for shape in shapes) else ["?"]
+    return "?"
+
+
+def _is_collscan(plan):
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            return True
+        return any(_is_collscan(value) for value in plan.values())
+    if isinstance(plan, list):
+        return any(_is_collscan(value) for value in plan)
+    return False
+
+
+def explain_collscan(collection, filter):
+    # Whether MongoDB answers this filter shape with a collection scan, explained
+    # once per shape; None when explain is off or unavailable
+    if not EXPLAIN:
+        return None
+    key = (collection.name, json.dumps(filter_shape(filter), sort_keys=True, default=str))
+    with _explained_lock:
+        if key in _explained:
+            return _explained[key]
+    try:
+        plan = collection.find(filter).limit(1).explain()
+        collscan = _is_collscan(plan.get("queryPlanner", {}).get("winningPlan", plan))
+    except Exception:
+        collscan = None
+    with _explained_lock:
+        _explained[key] = collscan
+    return collscan
+
+
+class Trace:
+    def __init__(self):
+        self.id = next(_rerun_ids)
+        self.started_at = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%f")
+        self.start = time.perf_counter()
+        self.section = None
+        self.section_start = None
+        self.sections = []
+        self.mongo = []
+
+    def begin_section(self, name):
+        self.end_section()
+        self.section = name
+        self.section_start = time.perf_counter()
+
+    def end_section(self):
+        if self.section is not None:
+            self.add_section(self.section, (time.perf_counter() - self.section_start) * 1000)
+        self.section = None
+
+    def add_section(self, name, ms):
+        self.sections.append({"name": name, "ms": round(ms, 3)})
+
+    def add_mongo(self, collection, command, filter, docs, ms, collscan=None):
+        self.mongo.append({
+            "section": self.section,
+            "collection": collection,
+            "command": command,
+            "filter": filter_shape(filter) if filter is not None else None,
+            "docs": docs,
+            "ms": round(ms, 3),
+            "slow": ms >= SLOW_MS,
+            "collscan": collscan
+        })
+
+    def summary(self):
+        total = (time.perf_counter() - self.start) * 1000
+        return {
+            "type": "rerun",
+            "rerun": self.id,
+            "ts": self.started_at,
+            "ms": round(total, 3),
+            "mongo_ms": round(sum(event["ms"] for event in self.mongo), 3),
+            "mongo_calls": len(self.mongo)
+        }
+
+    def write(self, summary):
+        lines = [dict(summary)]
+        lines += [dict(section, type="section", rerun=self.id) for section in self.sections]
+        lines += [dict(event, type="mongo", rerun=self.id) for event in self.mongo]
+        with _log_lock:
+            with open(LOG_PATH, 'a', encoding='utf-8') as f:
+                for line in lines:
+                    f.write(json.dumps(line, ensure_ascii=False, default=str) + "\n")
+
+
+class TracedCursor:
+    # Delegates to a pymongo cursor and times the work done while iterating it
+    def __init__(self, cursor, trace, collection, filter, collscan):
+        self._cursor = cursor
+        self._trace = trace
+        self._collection = collection
+        self._filter = filter
+        self._collscan = collscan
+        self._ms = 0.0
+        self._docs = 0
+        self._recorded = False
+
+    def __getattr__(self, attr):
+        return getattr(self._cursor, attr)
+
+    def _chain(self, method, *args, **kwargs):
+        self._cursor = getattr(self._cursor, method)(*args, **kwargs)
+        return self
+
+    def sort(self, *args, **kwargs):
+        return self._chain("sort", *args, **kwargs)
+
+    def limit(self, *args, **kwargs):
+        return self._chain("limit", *args, **kwargs)
+
+    def skip(self, *args, **kwargs):
+        return self._chain("skip", *args, **kwargs)
+
+    def batch_size(self, *args, **kwargs):
+        return self._chain("batch_size", *args, **kwargs)
+
+    def __iter__(self):
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    document = next(self._cursor)
+                except StopIteration:
+                    return
+                finally:
+                    self._ms += (time.perf_counter() - start) * 1000
+                self._docs += 1
+                yield document
+        finally:
+            self._record()
+
+    def close(self):
+        self._cursor.close()
+        self._record()
+
+    def _record(self):
+        if not self._recorded:
+            self._recorded = True
+            self._trace.add_mongo(self._collection, "find", self._filter, self._docs, self._ms, self._collscan)
+
+
+class TracedCollection:
+    def __init__(self, collection):
+        self._collection = collection
+        self.name = collection.name
+
+    def __getattr__(self, attr):
+        method = getattr(self._collection, attr)
+        if attr not in TIMED_METHODS:
+            return method
+
+        def timed(*args, **kwargs):
+            trace = _current.get()
+            if trace is None:
+                return method(*args, **kwargs)
+            if attr in FILTER_METHODS:
+                filter = args[0] if args else kwargs.get("filter")
+            elif attr == "distinct":
+                filter = args[1] if len(args) > 1 else kwargs.get("filter")
+            else:
+                filter = None
+            collscan = explain_collscan(self._collection, filter or {}) if attr == "find_one" else None
+            start = time.perf_counter()
+            result = method(*args, **kwargs)
+            ms = (time.perf_counter() - start) * 1000
+            if isinstance(result, list):
+                docs = len(result)
+            elif attr in ("find_one", "find_one_and_update"):
+                docs = int(result is not None)
+            elif attr == "insert_one":
+                docs = 1
+            elif attr in ("insert_many", "bulk_write") and args:
+                docs = len(args[0])
+            else:
+                docs = None
+            trace.add_mongo(self.name, attr, filter, docs, ms, collscan)
+            return result
+
+        return timed
+
+    def find(self, *args, **kwargs):
+        cursor = self._collection.find(*args, **kwargs)
+        trace = _current.get()
+        if trace is None:
+            return cursor
+        filter = args[0] if args else kwargs.get("filter", {})
+        return TracedCursor(cursor, trace, self.name, filter, explain_collscan(self._collection, filter or {}))
+
+    def __repr__(self):
+        return f"TracedCollection({self._collection!r})"
+
+
+def traced(collection):
+    # The collection wrapped for tracing, or the collection itself when tracing is off
+    return TracedCollection(collection) if ENABLED else collection
+
+
+def section(name):
+    # Start timing a UI section; the previous one ends here
+    trace = _current.get()
+    if trace is not None:
+        trace.begin_section(name)
+
+
+@contextmanager
+def _span(trace, name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_section(name, (time.perf_counter() - start) * 1000)
+
+
+def span(name):
+    # Time a block inside a section, e.g. span("rank_products")
+    trace = _current.get()
+    return _span(trace, name) if trace is not None else nullcontext()
+
+
+def bind(fn):
+    # fn, recording into the current rerun's trace when called from a worker thread
+    trace = _current.get()
+    if trace is None:
+        return fn
+
+    def run(*args, **kwargs):
+        token = _current.set(trace)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current.reset(token)
+
+    return run
+
+
+def render_panel(trace, summary):
+    import pandas as pd
+    import streamlit as st
+
+    with st.sidebar.expander("Performance"):
+        st.write(f"Rerun {trace.id}: {summary['ms']:.0f} ms, {summary['mongo_calls']} Mongo calls taking {summary['mongo_ms']:.0f} ms")
+        if trace.sections:
+            sections = pd.DataFrame(trace.sections)
+            mongo_ms = pd.DataFrame(trace.mongo or [{"section": None, "ms": 0.0}]).groupby("section")["ms"].sum()
+            sections["mongo_ms"] = sections["name"].map(mongo_ms).fillna(0.0)
+            st.dataframe(sections)
+        if trace.mongo:
+            queries = pd.DataFrame(trace.mongo).sort_values("ms", ascending=False)
+            queries["filter"] = queries["filter"].map(lambda shape: json.dumps(shape, ensure_ascii=False))
+            st.dataframe(queries)
+
+
+@contextmanager
+def _rerun():
+    trace = Trace()
+    token = _current.set(trace)
+    completed = False
+    try:
+        yield trace
+        completed = True
+    finally:
+        _current.reset(token)
+        trace.end_section()
+        summary = trace.summary()
+        if LOG_PATH:
+            trace.write(summary)
+        # A rerun requested mid-script (st.rerun) renders nothing
+        if PANEL and completed:
+            render_panel(trace, summary)
+
+
+def rerun():
+    # Wraps one execution of the app script
+    return _rerun() if ENABLED else nullcontext()